@@ -0,0 +1,113 @@
+import time
+import contextlib
+import contextvars
+
+
+class CallTracker():
+    """
+    Records every LLM and embedding call made while a test case runs: provider, model,
+    purpose (e.g. sub_query, sub_answer, relevance, final), latency, time to first token
+    (streamed responses only), token usage, time spent waiting for rate limits and whether
+    the response came from the response cache.
+
+    The calls are collected in a context variable, so concurrently running test cases
+    (threads or asyncio tasks) each collect their own calls. Calls outside of track()
+    (e.g. ingestion or prefetching) are not recorded.
+    """
+    _calls = contextvars.ContextVar("tracked_calls", default=None)
+    _purpose = contextvars.ContextVar("call_purpose", default=None)
+
+    usage_fields = ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens")
+
+    @classmethod
+    @contextlib.contextmanager
+    def track(cls, test_case=None):
+        """Collect the calls of the enclosed block; they are attached to test_case when it ends, also on errors."""
+        calls = []
+        token = cls._calls.set(calls)
+        try:
+            yield calls
+        finally:
+            cls._calls.reset(token)
+            if test_case is not None:
+                test_case.add_llm_calls(calls)
+
+    @classmethod
+    @contextlib.contextmanager
+    def purpose(cls, purpose: str):
+        """Purpose of the calls in the enclosed block that do not name one themselves."""
+        token = cls._purpose.set(purpose)
+        try:
+            yield
+        finally:
+            cls._purpose.reset(token)
+
+    @classmethod
+    def is_tracking(cls):
+        return cls._calls.get() is not None
+
+    @staticmethod
+    def usage(usage):
+        """Token usage of an OpenAI (chat or embedding) or xAI response as a flat dict."""
+        if usage is None:
+            return {}
+
+        def value(obj, *names):
+            for name in names:
+                obj = getattr(obj, name, None)
+                if obj is None:
+                    return None
+            return int(obj)
+
+        def first(*values):
+            # a reported 0 is kept, only a missing value falls back to the next field
+            return next((value for value in values if value is not None), None)
+
+        return {
+            "prompt_tokens": value(usage, "prompt_tokens"),
+            "completion_tokens": value(usage, "completion_tokens"),
+            # OpenAI reports reasoning and cached tokens in the details, xAI as top-level fields
+            "reasoning_tokens": first(value(usage, "completion_tokens_details", "reasoning_tokens"), value(usage, "reasoning_tokens")),
+            "cached_tokens": first(value(usage, "prompt_tokens_details", "cached_tokens"), value(usage, "cached_prompt_text_tokens")),
+        }
+
+    @classmethod
+    def record(cls, kind: str, provider: str, model: str, latency: float, usage=None, time_to_first_token=None,
+               wait_time=0.0, purpose=None, response_cache=False):
+        calls = cls._calls.get()
+        if calls is None:
+            return
+        calls.append({
+            "kind": kind,
+            "provider": provider,
+            "model": model,
+            "purpose": purpose or cls._purpose.get(),
+            "latency": round(latency, 4),
+            "time_to_first_token": round(time_to_first_token, 4) if time_to_first_token is not None else None,
+            "wait_time": round(wait_time, 4),
+            "response_cache": response_cache,
+            **{field: (usage or {}).get(field) for field in cls.usage_fields},
+            "recorded_at": time.time(),
+        })
+
+    @classmethod
+    def summarize(cls, calls, purposes=None):
+        """Totals over a test case's calls: overall and per purpose (calls, latency, tokens)."""
+        calls = calls or []
+        summary = {
+            "llm calls": sum(1 for call in calls if call["kind"] == "llm"),
+            "embedding calls": sum(1 for call in calls if call["kind"] == "embedding"),
+            "cached llm calls": sum(1 for call in calls if call.get("response_cache")),
+            "llm latency": round(sum(call["latency"] for call in calls if call["kind"] == "llm"), 4),
+            "embedding latency": round(sum(call["latency"] for call in calls if call["kind"] == "embedding"), 4),
+            "rate limit wait": round(sum(call.get("wait_time") or 0 for call in calls), 4),
+        }
+        for field in cls.usage_fields:
+            summary[field.replace("_", " ")] = sum(call.get(field) or 0 for call in calls if call["kind"] == "llm")
+        summary["embedding tokens"] = sum(call.get("prompt_tokens") or 0 for call in calls if call["kind"] == "embedding")
+        for purpose in purposes or ():
+            purpose_calls = [call for call in calls if call["kind"] == "llm" and call.get("purpose") == purpose]
+            summary[f"{purpose} calls"] = len(purpose_calls)
+            summary[f"{purpose} latency"] = round(sum(call["latency"] for call in purpose_calls), 4)
+            summary[f"{purpose} tokens"] = sum((call.get("prompt_tokens") or 0) + (call.get("completion_tokens") or 0) for call in purpose_calls)
+        return summary
@@ -1,8 +1,21 @@
 import yaml
 import os
 import json
+import time
+import heapq
+import shutil
+import threading
 import chromadb
 from datetime import datetime
+from token_handler import split_text
+from embedding_storage import EmbeddingStorage
+from vector_index import NumpyVectorIndex
+from columnar_store import ColumnarStore
+from lexical_index import LexicalIndex
+from retrieval_router import MetadataFilter
+from embedders import create_embedder
+from context_selection import ContextSelector
+from call_tracker import CallTracker
 
 
 
@@ -12,103 +25,373 @@ with open('config.yaml', 'r') as f:
 
 class ChromaDB():
     chroma_persist_dir = cfg.get('embedding').get('chroma_persist_directory')
+    # embedding backend (OpenAI API, local ONNX model or hashing), see `embedder` in config.yaml
+    _embedder = None
+    # Process-wide clients and collection handles per persist directory, shared by all
+    # instances and threads. Opening a PersistentClient and looking up a collection costs
+    # more than a single vector search, so retrieval should only pay for the query itself.
+    _clients = {}
+    _collection_handles = {}
+    _collection_names = {}
+    _client_lock = threading.RLock()
+    # query embeddings are cached process-wide as well, every test case creates its own ChromaDB
+    _query_embedding_cache = None
+    # results of prefetch(), keyed by (knowledge basis, top n, query text, filter)
+    _prefetched_results = {}
+    # threads that query the collections of a retrieval concurrently
+    _search_executor = None
+    # one thread builds a missing lexical index, the others wait for it
+    _lexical_rebuild_lock = threading.Lock()
+
     def __init__(self):
         self.chroma_persist_dir = self.chroma_persist_dir
+        self.embedding_cache = None
+
+    @classmethod
+    def shared_client(cls, persist_dir=None):
+        persist_dir = persist_dir or cls.chroma_persist_dir
+        client = cls._clients.get(persist_dir)
+        if client is None:
+            with cls._client_lock:
+                client = cls._clients.get(persist_dir)
+                if client is None:
+                    client = cls._clients[persist_dir] = chromadb.PersistentClient(path=persist_dir) # type: ignore
+        return client
+
+    @classmethod
+    def shared_collection(cls, collection_name, persist_dir=None, create=False):
+        """Cached collection handle; raises like chromadb if it does not exist and create is False."""
+        persist_dir = persist_dir or cls.chroma_persist_dir
+        key = (persist_dir, collection_name)
+        collection = cls._collection_handles.get(key)
+        if collection is None:
+            with cls._client_lock:
+                collection = cls._collection_handles.get(key)
+                if collection is None:
+                    client = cls.shared_client(persist_dir)
+                    if create:
+                        collection = client.get_or_create_collection(name=collection_name)
+                        cls._collection_names.pop(persist_dir, None)
+                    else:
+                        collection = client.get_collection(collection_name)
+                    cls._collection_handles[key] = collection
+        return collection
+
+    @classmethod
+    def shared_collection_names(cls, persist_dir=None):
+        persist_dir = persist_dir or cls.chroma_persist_dir
+        names = cls._collection_names.get(persist_dir)
+        if names is None:
+            with cls._client_lock:
+                names = cls._collection_names[persist_dir] = [col.name for col in cls.shared_client(persist_dir).list_collections()]
+        return names
+
+    @classmethod
+    def _forget_collection(cls, collection_name, persist_dir=None):
+        persist_dir = persist_dir or cls.chroma_persist_dir
+        with cls._client_lock:
+            cls._collection_handles.pop((persist_dir, collection_name), None)
+            cls._collection_names.pop(persist_dir, None)
+
+    def get_client(self):
+        return self.shared_client(self.chroma_persist_dir)
+
+    def get_collection(self, collection_name, create=False):
+        return self.shared_collection(collection_name, self.chroma_persist_dir, create)
+
+    def get_embedding_cache(self):
+        if self.embedding_cache is None:
+            from embedding_cache import EmbeddingCache
+            cache_path = cfg.get('embedding', {}).get('embedding_cache_path') or os.path.join(self.chroma_persist_dir, "embedding_cache.sqlite3")
+            self.embedding_cache = EmbeddingCache(cache_path)
+        return self.embedding_cache
+
+    @classmethod
+    def get_query_embedding_cache(cls):
+        if cls._query_embedding_cache is None:
+            with cls._client_lock:
+                if cls._query_embedding_cache is None:
+                    from embedding_cache import QueryEmbeddingCache
+                    embedding_cfg = cfg.get('embedding', {})
+                    cache_path = embedding_cfg.get('query_cache_path') or os.path.join(cls.chroma_persist_dir, "query_embedding_cache.sqlite3")
+                    cls._query_embedding_cache = QueryEmbeddingCache(cache_path, embedding_cfg.get('query_cache_max_entries'))
+        return cls._query_embedding_cache
+
+    def create_query_embeddings(self, query_texts):
+        """
+        Embed retrieval queries, reusing embeddings of queries seen before (also in earlier
+        runs). Only queries missing from the query cache are sent to the API.
+        """
+        import hashlib
+
+        embedding_model, dimensions = self.embedding_cache_key()
+        query_cache = self.get_query_embedding_cache()
+        query_hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in query_texts]
+        embeddings = query_cache.get_many(query_hashes, embedding_model, dimensions)
+
+        missing = {query_hash: text for query_hash, text in zip(query_hashes, query_texts) if query_hash not in embeddings}
+        if missing:
+            with CallTracker.purpose("query_embedding"):
+                new_embeddings = dict(zip(missing, self.create_vector_embeddings(list(missing.values()))))
+            query_cache.put_many(new_embeddings, embedding_model, dimensions)
+            embeddings.update(new_embeddings)
+
+        return [embeddings[query_hash] for query_hash in query_hashes]
+
+    def create_query_embedding(self, query_text):
+        return self.create_query_embeddings([query_text])[0]
+
+    @classmethod
+    def query_cache_stats(cls):
+        return cls.get_query_embedding_cache().stats()
 
     def create_vector_embedding(self, input):
-        from openai import OpenAI 
-        from dotenv import load_dotenv
-        load_dotenv()
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        openai_embedding_model = cfg.get('embedding', {}).get('openAI_embedding_model')
-
-        # Create embedding using OpenAI API
-        client = OpenAI(api_key=openai_api_key)
-        response = client.embeddings.create(
-            input=input,
-            model=openai_embedding_model
-        )
-        # Prepare metadata, filtering out None values
+        return self.create_vector_embeddings([input])[0]
+
+    def create_vector_embeddings(self, inputs):
+        """
+        Embed a list of texts with the configured embedder (see embedders.py).
+        Returns the embeddings in the same order as the inputs. Calls of local embedders
+        are recorded here with CallTracker, the OpenAI embedder records each request itself.
+        """
+        embedder = self.get_embedder()
+        if embedder.records_calls or not CallTracker.is_tracking():
+            return embedder.embed(inputs)
+        start = time.perf_counter()
+        embeddings = embedder.embed(inputs)
+        CallTracker.record("embedding", embedder.provider, embedder.model_name, time.perf_counter() - start)
+        return embeddings
+
+    @classmethod
+    def get_embedder(cls):
+        if cls._embedder is None:
+            with cls._client_lock:
+                if cls._embedder is None:
+                    cls._embedder = create_embedder()
+        return cls._embedder
 
-        
-        return response.data[0].embedding  
+    @classmethod
+    def embedding_cache_key(cls):
+        """(model, dimensions) under which embeddings are cached, so backends never share entries."""
+        return cls.get_embedder().cache_key()
+
+    @classmethod
+    def embedding_dimensions(cls):
+        """Length of the configured embeddings, None if it is unknown before the first call."""
+        return cls.get_embedder().expected_dimensions()
+
+    @classmethod
+    def ingestion_settings(cls):
+        """Settings that change the stored chunks; the index is rebuilt if any of them changes."""
+        embedding_cfg = cfg.get('embedding', {})
+        settings = {
+            "openAI_embedding_model": embedding_cfg.get('openAI_embedding_model'),
+            "dimensions": embedding_cfg.get('dimensions'),
+            "max_chunk_size": embedding_cfg.get('max_chunk_size'),
+            "chunk_overlap": embedding_cfg.get('chunk_overlap'),
+            "api_chunk_format": "compact_json",
+            "api_chunk_fields": embedding_cfg.get('api_chunk_fields'),
+            "api_chunk_droppable_fields": embedding_cfg.get('api_chunk_droppable_fields'),
+        }
+        # indexes built with the OpenAI embedder keep their settings, other embedders are recorded by name
+        embedder = cls.get_embedder()
+        if embedder.model_name != embedding_cfg.get('openAI_embedding_model'):
+            settings["embedder"] = embedder.model_name
+        return settings
 
     @classmethod
     def _count_total_embeddings(cls):
-        client = chromadb.PersistentClient(cls.chroma_persist_dir) # type: ignore
         total_embeddings = 0
-        for collection in client.list_collections():
-            coll = client.get_collection(collection.name)
-            total_embeddings += coll.count()
+        for collection_name in cls.shared_collection_names():
+            total_embeddings += cls.shared_collection(collection_name).count()
         print(f"Total embeddings in ChromaDB: {total_embeddings}")
 
     def add_embedding_to_db(self, text, file_name, business_object, source_type):
-        import hashlib 
-        from langchain_text_splitters import TokenTextSplitter
-
-        text_splitter = TokenTextSplitter(
-            chunk_size=cfg.get('embedding', {}).get('max_chunk_size'),
-            chunk_overlap=cfg.get('embedding', {}).get('chunk_overlap'),
-        )
-
-        raw_chunks = text_splitter.split_text(text)
+        self.add_embeddings_to_db([{
+            "text": text,
+            "file_name": file_name,
+            "business_object": business_object,
+            "source_type": source_type,
+        }])
 
-        # Initialize ChromaDB client with persistence
-        client = chromadb.PersistentClient(  # type: ignore
-            path=self.chroma_persist_dir
-        )
-
-        # Decide collection name once
+    @staticmethod
+    def collection_name(source_type):
         if source_type == "API":
-            collection_name = "API_embeddings"
+            return "API_embeddings"
         elif source_type == "DB":
-            collection_name = "DB_embeddings"
+            return "DB_embeddings"
         elif source_type == "TXT":
-            collection_name = "TXT_embeddings"
+            return "TXT_embeddings"
         else:
             raise ValueError(f"Unknown source type: {source_type}")
 
-        collection = client.get_or_create_collection(name=collection_name)
-
-        # Ensure the JSON dump folder exists: <persist_dir>/<collection_name>
-        json_out_dir = os.path.join(self.chroma_persist_dir, collection_name)
-        os.makedirs(json_out_dir, exist_ok=True)
-
-        for i, raw_chunk in enumerate(raw_chunks, start=1):
-            embedding = self.create_vector_embedding(raw_chunk)
-
-            metadata = {
-                k: v for k, v in {
-                    "id": hashlib.sha256(str(raw_chunk).encode("utf-8")).hexdigest(),
-                    "file_name": file_name,
-                    "business_object": business_object,
-                    "source_type": source_type,
-                }.items() if v is not None
-            }
-
-            record = {
-                "id": metadata["id"],
-                "chunk_index": i,
-                "text": raw_chunk,
-                "embedding": embedding,
-                "metadata": metadata,
-                "created_at": datetime.utcnow().isoformat() + "Z",
-            }
-
-            json_path = os.path.join(json_out_dir, f"{metadata['id']}.json")
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(record, f, ensure_ascii=False)
-
-            # --- Existing: store in Chroma collection ---
-            collection.add(
-                ids=metadata.get('id'),          # type: ignore
-                embeddings=embedding,
-                documents=raw_chunk,
-                metadatas=[metadata]             # type: ignore
-            )
+    def add_embeddings_to_db(self, documents):
+        """
+        Split, embed and store a list of documents.
+        Each document is a dict with the keys text, file_name, business_object and source_type.
+        All chunks of all documents are embedded together, so the number of embedding
+        requests depends on the total token volume and not on the number of chunks.
+        Returns one list of chunk ids per document (in input order).
+        """
+        records, document_chunk_ids = self.split_documents(documents)
+        if not records:
+            return document_chunk_ids
+
+        collections = self.get_collections({record["collection"] for record in records})
+        pending_records, cached_embeddings, stored_count = self.select_pending_records(records, collections)
+
+        missing_ids = list(dict.fromkeys(record["metadata"]["id"] for record in pending_records if record["metadata"]["id"] not in cached_embeddings))
+        missing_texts = {record["metadata"]["id"]: record["text"] for record in pending_records}
+        cached_count = sum(1 for record in pending_records if record["metadata"]["id"] in cached_embeddings)
+        print(f"Embedding cache: {stored_count} chunks already stored, {cached_count} cached, {len(missing_ids)} to embed")
+        if missing_ids:
+            new_embeddings = dict(zip(missing_ids, self.create_vector_embeddings([missing_texts[id] for id in missing_ids])))
+            self.get_embedding_cache().put_many(new_embeddings, *self.embedding_cache_key())
+            cached_embeddings.update(new_embeddings)
+
+        self.store_records(pending_records, [cached_embeddings[record["metadata"]["id"]] for record in pending_records], collections)
+
+        return document_chunk_ids
+
+    def split_documents(self, documents):
+        """
+        Split documents into chunk records (collection, chunk_index, text, metadata).
+        Returns (records, document_chunk_ids) with one list of chunk ids per document.
+        """
+        import hashlib 
+
+        records = []
+        document_chunk_ids = []
+        for document in documents:
+            collection_name = self.collection_name(document["source_type"])
+            raw_chunks = split_text(document["text"])
+            document_chunk_ids.append([])
+            for i, raw_chunk in enumerate(raw_chunks, start=1):
+                metadata = {
+                    k: v for k, v in {
+                        "id": hashlib.sha256(str(raw_chunk).encode("utf-8")).hexdigest(),
+                        "file_name": document.get("file_name"),
+                        "business_object": document.get("business_object"),
+                        "source_type": document["source_type"],
+                        "chunk_index": i,
+                    }.items() if v is not None
+                }
+                records.append({
+                    "collection": collection_name,
+                    "chunk_index": i,
+                    "text": raw_chunk,
+                    "metadata": metadata,
+                })
+                document_chunk_ids[-1].append(metadata["id"])
+
+        return records, document_chunk_ids
+
+    def get_collections(self, collection_names):
+        """
+        Open (or create) the collections. A collection that holds embeddings of another
+        length than the configured model/dimensions produce is recreated, since Chroma
+        cannot store vectors of different sizes in one collection.
+        """
+        client = self.get_client()
+        dimensions = self.embedding_dimensions()
+        collections = {}
+        for collection_name in collection_names:
+            collection = self.get_collection(collection_name, create=True)
+            sidecar_folder = os.path.join(self.chroma_persist_dir, collection_name)
+            stored = collection.peek(1).get("embeddings") if dimensions else None
+            if stored is not None and len(stored) and len(stored[0]) != dimensions:
+                print(f"{collection_name} holds {len(stored[0])}-dimensional embeddings, recreating it for {dimensions} dimensions")
+                client.delete_collection(collection_name)
+                self._forget_collection(collection_name, self.chroma_persist_dir)
+                shutil.rmtree(sidecar_folder, ignore_errors=True)
+                NumpyVectorIndex.invalidate(self.chroma_persist_dir, collection_name)
+                LexicalIndex.invalidate(self.chroma_persist_dir, collection_name)
+                collection = self.get_collection(collection_name, create=True)
+            collections[collection_name] = collection
+            # Ensure the JSON dump folder exists: <persist_dir>/<collection_name>
+            os.makedirs(sidecar_folder, exist_ok=True)
+            # chunks stored before the lexical index was enabled are only added by the ingestion if they change
+            if cfg.get('embedding', {}).get('lexical_index') and not os.path.exists(os.path.join(sidecar_folder, LexicalIndex.table_file)) and collection.count():
+                LexicalIndex.rebuild(self, [collection_name])
+        return collections
+
+    def select_pending_records(self, records, collections, seen=None):
+        """
+        Drop records that are already stored and look up cached embeddings for the rest.
+        Returns (pending_records, cached_embeddings, stored_count); cached_embeddings maps
+        chunk id -> embedding. `seen` collects (collection, id) keys across calls, so that
+        identical chunks are only stored once per collection.
+        """
+        # Look up chunks that were embedded before (same text, model and dimensions)
+        embedding_model, dimensions = self.embedding_cache_key()
+        cached_embeddings = self.get_embedding_cache().get_many([record["metadata"]["id"] for record in records], embedding_model, dimensions)
+
+        # Cached chunks that are already stored in their collection need neither an API call nor a write
+        stored_ids = set()
+        for collection_name, collection in collections.items():
+            hit_ids = list({record["metadata"]["id"] for record in records if record["collection"] == collection_name and record["metadata"]["id"] in cached_embeddings})
+            if hit_ids:
+                stored_ids.update((collection_name, id) for id in collection.get(ids=hit_ids, include=[])["ids"])
+
+        # identical chunks (same id) are only stored once per collection
+        if seen is None:
+            seen = set()
+        seen.update(stored_ids)
+        pending_records = []
+        for record in records:
+            key = (record["collection"], record["metadata"]["id"])
+            if key in seen:
+                continue
+            seen.add(key)
+            pending_records.append(record)
+
+        return pending_records, cached_embeddings, len(stored_ids)
+
+    def store_records(self, records, embeddings, collections):
+        """Write chunk records with their embeddings to the JSON sidecars and the Chroma collections."""
+        batcher = ChromaWriteBatcher(self, collections)
+        for record, embedding in zip(records, embeddings):
+            batcher.add(record, embedding)
+        batcher.flush()
+
+    def delete_embeddings(self, ids_by_source_type: dict):
+        """Remove chunks (Chroma entries and sidecars) given as {source_type: [ids]}."""
+        existing_collections = set(self.shared_collection_names(self.chroma_persist_dir))
+        for source_type, ids in ids_by_source_type.items():
+            collection_name = self.collection_name(source_type)
+            if not ids or collection_name not in existing_collections:
+                continue
+            self.get_collection(collection_name).delete(ids=list(ids))
+            for id in ids:
+                json_path = os.path.join(self.chroma_persist_dir, collection_name, f"{id}.json")
+                if os.path.exists(json_path):
+                    os.remove(json_path)
+            sidecar_folder = os.path.join(self.chroma_persist_dir, collection_name)
+            if ColumnarStore.exists(sidecar_folder):
+                store = ColumnarStore(sidecar_folder)
+                store.delete(ids)
+                store.close()
+            NumpyVectorIndex.invalidate(self.chroma_persist_dir, collection_name)
+            LexicalIndex.delete(self.chroma_persist_dir, collection_name, ids)
+            print(f"Removed {len(ids)} stale chunks from {collection_name}")
 
     def evaluate_relevance(self, chunk, user_input, initial_system_prompt):
         from llm_handler import LLMQuery
+        relevance_system_prompt, user_prompt = self._relevance_prompts(chunk, user_input, initial_system_prompt)
+        query = LLMQuery("a", "b", purpose="relevance")
+        relevant = query.process(system_prompt=relevance_system_prompt, user_prompt=user_prompt)
+
+        return relevant
+
+    async def aevaluate_relevance(self, chunk, user_input, initial_system_prompt):
+        """Async counterpart of evaluate_relevance, for grading several chunks concurrently."""
+        from llm_handler import LLMQuery
+        relevance_system_prompt, user_prompt = self._relevance_prompts(chunk, user_input, initial_system_prompt)
+        query = LLMQuery("a", "b", purpose="relevance")
+        return await query.aprocess(system_prompt=relevance_system_prompt, user_prompt=user_prompt)
+
+    @staticmethod
+    def _relevance_prompts(chunk, user_input, initial_system_prompt):
         relevance_system_prompt = """You are an expert whose task is to critique how relevant a single retrieved system documentation chunk is to a user's query. You will be given three inputs: "General Task", "User Query" and "Retrieved System Documentation".
 
 Return a single true or false based on the relevance score.
@@ -122,50 +405,350 @@ Constraints:
 - Keep your response strictly as a boolean value (no extra commentary outside the boolean)."""
 
 
-        query = LLMQuery("a", "b")
         general_task = initial_system_prompt
         user_prompt = "General Task: {}\n\nUser Query: {}\n\nRetrieved System Documentation: {}".format(general_task, user_input, chunk)
-        relevant = query.process(system_prompt=relevance_system_prompt, user_prompt=user_prompt)
-
-        return relevant
+        return relevance_system_prompt, user_prompt
             
 
-    def retrieve(self, query_text, top_n_entries=None):
+    @staticmethod
+    def sidecar_format():
+        """"json" (one file per chunk) or "columnar" (see ColumnarStore)."""
+        sidecar_format = cfg.get('embedding', {}).get('sidecar_format') or "json"
+        if sidecar_format not in ("json", "columnar"):
+            raise ValueError(f"Unknown sidecar format: {sidecar_format}")
+        return sidecar_format
+
+    @staticmethod
+    def retrieval_mode():
+        """"vector", "lexical" (BM25 index only) or "hybrid" (reciprocal rank fusion of both)."""
+        retrieval_mode = cfg.get('embedding', {}).get('retrieval_mode') or "vector"
+        if retrieval_mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown retrieval mode: {retrieval_mode}")
+        return retrieval_mode
+
+    @staticmethod
+    def retrieval_backend():
+        """"chroma" (HNSW index of the collections) or "numpy" (exact search on the JSON sidecars)."""
+        backend = cfg.get('embedding', {}).get('retrieval_backend') or "chroma"
+        if backend not in ("chroma", "numpy"):
+            raise ValueError(f"Unknown retrieval backend: {backend}")
+        return backend
+
+    def _retrieval_collections(self, knowledge_basis):
+        if knowledge_basis == "DB":
+            return ["DB_embeddings", "TXT_embeddings"]
+        elif knowledge_basis == "API":
+            return ["API_embeddings", "TXT_embeddings"]
+        if self.retrieval_backend() == "numpy":
+            collection_names = NumpyVectorIndex.collection_names(self.chroma_persist_dir)
+            # like a missing API or DB collection, an index without any sidecars is an error, not an empty result
+            if not collection_names:
+                raise ValueError(f"No collection sidecars in {self.chroma_persist_dir}, the numpy retrieval backend needs the sidecars written by the ingestion.")
+            return collection_names
+        return self.shared_collection_names(self.chroma_persist_dir)
+
+    def _search_collection(self, collection_name):
+        # both backends answer query(query_embeddings, n_results) with chromadb's result structure
+        if self.retrieval_backend() == "numpy":
+            metric = cfg.get('embedding', {}).get('numpy_index_metric') or "l2"
+            return NumpyVectorIndex.shared(self.chroma_persist_dir, collection_name, metric, self.sidecar_format())
+        return self.get_collection(collection_name)
+
+    def retrieve(self, query_text, top_n_entries=None, where=None):
+        """
+        Retrieve the top_n_entries chunks closest to the query. `where` restricts the search
+        to chunks whose metadata match (Chroma `where` syntax), e.g.
+        {"business_object": "bank_account_entry"} or {"source_type": {"$in": ["API", "TXT"]}}.
+        """
         knowledge_basis = cfg.get('process_orchestration').get('knowledge_basis').upper()
         if top_n_entries is None:
             top_n_entries = cfg.get('embedding', {}).get('top_n_entries')
-        input_embedding = self.create_vector_embedding(query_text)
+        prefetched = self._prefetched_results.get((knowledge_basis, top_n_entries, query_text, MetadataFilter.key(where)))
+        if prefetched is not None:
+            return list(prefetched)
+        return self.retrieve_many([query_text], top_n_entries, where)[0]
 
-        chroma_client = chromadb.PersistentClient(self.chroma_persist_dir) 
-        
-        if knowledge_basis == "DB":
-            collections = ["DB_embeddings", "TXT_embeddings"]
-        elif knowledge_basis == "API":
-            collections = ["API_embeddings", "TXT_embeddings"]
-        else:
-            collections = [col.name for col in chroma_client.list_collections()]
-        results = []
-        for collection_name in collections:
-            collection = chroma_client.get_collection(collection_name)
-            query_result = collection.query(
-                query_embeddings=[input_embedding],
-                n_results=top_n_entries
+    def retrieve_many(self, query_texts, top_n_entries=None, where=None):
+        """
+        Retrieve the documentation for several queries at once.
+        All queries are embedded in batched requests and every collection is searched with
+        a single query for all queries that share a metadata filter. Returns one result list
+        per query, merged over the collections and sorted by distance exactly like retrieve().
+        `where` is one filter for all queries or a list with one filter per query; with
+        `route_business_objects` the chunks of the business objects a query without filter
+        mentions (see BusinessObjectRouter) are ranked higher: the search restricted to them
+        and the unrestricted one are fused by reciprocal rank fusion, so chunks of other
+        business objects are still found if the router picked the wrong ones.
+        With retrieval_mode "lexical" the BM25 index is searched instead (no embedding call),
+        with "hybrid" both result lists are fused by reciprocal rank fusion; the distance of
+        fused results is the negative fusion score.
+        With `context_selection` mmr_candidates chunks are retrieved per query and the
+        top_n_entries are picked from them by ContextSelector (MMR, overlapping chunks stitched).
+        """
+        knowledge_basis = cfg.get('process_orchestration').get('knowledge_basis').upper()
+        if top_n_entries is None:
+            top_n_entries = cfg.get('embedding', {}).get('top_n_entries')
+        # without a knowledge basis no documentation is returned, so nothing has to be embedded or searched
+        if knowledge_basis == "NONE" or not query_texts:
+            return [[] for _ in query_texts]
+        query_texts = list(query_texts)
+        collection_names = self._retrieval_collections(knowledge_basis)
+        retrieval_mode = self.retrieval_mode()
+        context_selection = bool(cfg.get('embedding', {}).get('context_selection'))
+        n_results = max(top_n_entries, cfg.get('embedding', {}).get('mmr_candidates') or top_n_entries) if context_selection else top_n_entries
+
+        filters = list(where) if isinstance(where, (list, tuple)) else [where] * len(query_texts)
+        # filter of the routed business objects per query, whose chunks are ranked higher
+        boosts = [None] * len(query_texts)
+        if cfg.get('embedding', {}).get('route_business_objects'):
+            from retrieval_router import BusinessObjectRouter
+            router = BusinessObjectRouter.shared()
+            boosts = [router.where(query_text) if query_filter is None else None for query_filter, query_text in zip(filters, query_texts)]
+        # queries with the same filter and routing are searched together
+        groups = {}
+        for q, (query_filter, boost) in enumerate(zip(filters, boosts)):
+            groups.setdefault((MetadataFilter.key(query_filter), MetadataFilter.key(boost)), (query_filter, boost, []))[2].append(q)
+
+        input_embeddings = None if retrieval_mode == "lexical" and not context_selection else self.create_query_embeddings(query_texts)
+        all_results = [None] * len(query_texts)
+        for query_filter, boost, positions in groups.values():
+            group_texts = [query_texts[q] for q in positions]
+            group_embeddings = None if input_embeddings is None else [input_embeddings[q] for q in positions]
+            group_results = self._search_mode(retrieval_mode, collection_names, n_results, group_texts, group_embeddings, query_filter)
+            if boost is not None:
+                # chunks of the routed business objects appear in both rankings and move up
+                boosted_results = self._search_mode(retrieval_mode, collection_names, n_results, group_texts, group_embeddings, boost)
+                group_results = [self._fuse_rankings([boosted, results], n_results) for boosted, results in zip(boosted_results, group_results)]
+            for q, results in zip(positions, group_results):
+                all_results[q] = results
+
+        if context_selection:
+            chunk_embeddings = self.chunk_embeddings([entry for results in all_results for entry in results])
+            all_results = [
+                ContextSelector.select(query_embedding, results, [chunk_embeddings[(entry["collection"], entry["id"])] for entry in results], top_n_entries)
+                for query_embedding, results in zip(input_embeddings, all_results)
+            ]
+        return all_results
+
+    def _search_mode(self, retrieval_mode, collection_names, n_results, query_texts, query_embeddings, where):
+        """Search the collections with the queries of one group in the given retrieval mode."""
+        if retrieval_mode == "lexical":
+            return self._search(collection_names, n_results, query_texts=query_texts, where=where)
+        elif retrieval_mode == "vector":
+            return self._search(collection_names, n_results, query_embeddings=query_embeddings, where=where)
+        n_candidates = max(n_results, cfg.get('embedding', {}).get('hybrid_candidates') or n_results)
+        vector_results = self._search(collection_names, n_candidates, query_embeddings=query_embeddings, where=where)
+        lexical_results = self._search(collection_names, n_candidates, query_texts=query_texts, where=where)
+        return [self._fuse_rankings([vector, lexical], n_results) for vector, lexical in zip(vector_results, lexical_results)]
+
+    def chunk_embeddings(self, entries):
+        """
+        Embeddings of retrieved chunks as dict (collection, id) -> embedding. They are read
+        from the embedding cache (keyed by chunk id) and, if missing there, from Chroma.
+        """
+        ids = list(dict.fromkeys(entry["id"] for entry in entries))
+        cached = self.get_embedding_cache().get_many(ids, *self.embedding_cache_key())
+        embeddings = {}
+        missing = {}
+        for entry in entries:
+            key = (entry["collection"], entry["id"])
+            if entry["id"] in cached:
+                embeddings[key] = cached[entry["id"]]
+            elif key not in embeddings:
+                missing.setdefault(entry["collection"], []).append(entry["id"])
+        for collection_name, collection_ids in missing.items():
+            stored = self.get_collection(collection_name).get(ids=list(dict.fromkeys(collection_ids)), include=["embeddings"])
+            for id, embedding in zip(stored["ids"], stored["embeddings"]):
+                embeddings[(collection_name, id)] = embedding
+        return embeddings
+
+    @classmethod
+    def get_search_executor(cls):
+        if cls._search_executor is None:
+            with cls._client_lock:
+                if cls._search_executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    cls._search_executor = ThreadPoolExecutor(
+                        max_workers=cfg.get('embedding', {}).get('retrieval_threads') or 4,
+                        thread_name_prefix="collection-search"
+                    )
+        return cls._search_executor
+
+    def lexical_index(self, collection_name):
+        """
+        BM25 index of a collection. Collections ingested without `lexical_index` (or before
+        it existed) have no lexical.sqlite3; their index is built from Chroma on first use,
+        so lexical and hybrid retrieval never search an empty index by mistake.
+        """
+        index = LexicalIndex.shared(self.chroma_persist_dir, collection_name)
+        if index.count() or os.path.exists(index.path):
+            return index
+        with self._lexical_rebuild_lock:
+            if not os.path.exists(index.path) and self.get_collection(collection_name).count():
+                print(f"[WARN] {collection_name} has no lexical index, building it from the Chroma collection")
+                LexicalIndex.rebuild(self, [collection_name])
+        return LexicalIndex.shared(self.chroma_persist_dir, collection_name)
+
+    def _query_collection(self, collection_name, top_n_entries, query_embeddings=None, query_texts=None, where=None):
+        if query_texts is not None:
+            return self.lexical_index(collection_name).query(query_texts, n_results=top_n_entries, where=where)
+        collection = self._search_collection(collection_name)
+        return collection.query(
+            query_embeddings=query_embeddings,
+            n_results=top_n_entries,
+            **({"where": where} if where else {})
+        )
+
+    def _search(self, collection_names, top_n_entries, query_embeddings=None, query_texts=None, where=None):
+        """
+        Search the collections with embeddings (vector backend) or texts (BM25 index).
+        The collections are queried concurrently, so searching all of them takes about as
+        long as the slowest one; per query the top n rows over all collections are picked
+        with a bounded heap and only those are turned into result dicts.
+        """
+        n_queries = len(query_texts) if query_texts is not None else len(query_embeddings)
+        # the calling thread searches the first collection itself instead of waiting idle
+        futures = [
+            self.get_search_executor().submit(self._query_collection, collection_name, top_n_entries, query_embeddings, query_texts, where)
+            for collection_name in collection_names[1:]
+        ]
+        query_results = [self._query_collection(collection_name, top_n_entries, query_embeddings, query_texts, where) for collection_name in collection_names[:1]]
+        query_results.extend(future.result() for future in futures)
+
+        all_results = []
+        for q in range(n_queries):
+            # (distance, collection position, row) in collection order, nsmallest keeps that order for equal distances
+            candidates = (
+                (distance, c, i)
+                for c, query_result in enumerate(query_results)
+                for i, distance in enumerate(query_result["distances"][q])
             )
-            # collect rows
-            for i in range(len(query_result["ids"][0])):
+            results = []
+            for distance, c, i in heapq.nsmallest(top_n_entries, candidates, key=lambda candidate: candidate[0]):
+                query_result = query_results[c]
                 results.append({
-                    "collection": collection_name,
-                    "id": query_result["ids"][0][i],
-                    "document": (query_result.get("documents") or [[]])[0][i] if query_result.get("documents") else None,
-                    "metadata": (query_result.get("metadatas") or [[]])[0][i] if query_result.get("metadatas") else None,
-                    "distance": (query_result.get("distances") or [[]])[0][i] if query_result.get("distances") else None,
+                    "collection": collection_names[c],
+                    "id": query_result["ids"][q][i],
+                    "document": query_result["documents"][q][i] if query_result.get("documents") else None,
+                    "metadata": query_result["metadatas"][q][i] if query_result.get("metadatas") else None,
+                    "distance": distance,
                 })
-              
-        # Sort all results by distance (ascending)
-        results.sort(key=lambda x: x['distance'])
-        
-        # Return top n closest entries across all collections
-        if knowledge_basis == "NONE":
-            top_n_entries = 0
-
-        return results[:top_n_entries]
\ No newline at end of file
+            all_results.append(results)
+        return all_results
+
+    @staticmethod
+    def _fuse_rankings(rankings, top_n_entries):
+        """Reciprocal rank fusion: every ranking adds 1 / (rrf_k + rank) to a chunk's score."""
+        rrf_k = cfg.get('embedding', {}).get('rrf_k') or 60
+        scores = {}
+        entries = {}
+        for ranking in rankings:
+            for rank, entry in enumerate(ranking, start=1):
+                key = (entry["collection"], entry["id"])
+                scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+                entries.setdefault(key, entry)
+        fused = sorted(scores, key=lambda key: -scores[key])[:top_n_entries]
+        return [{**entries[key], "distance": -scores[key]} for key in fused]
+
+    def prefetch(self, query_texts, top_n_entries=None):
+        """
+        Retrieve the documentation for known queries up front with retrieve_many; later
+        retrieve() calls for the same query are answered from memory.
+        """
+        knowledge_basis = cfg.get('process_orchestration').get('knowledge_basis').upper()
+        if top_n_entries is None:
+            top_n_entries = cfg.get('embedding', {}).get('top_n_entries')
+        query_texts = [text for text in dict.fromkeys(query_texts) if text]
+        for results, query_text in zip(self.retrieve_many(query_texts, top_n_entries), query_texts):
+            self._prefetched_results[(knowledge_basis, top_n_entries, query_text, None)] = results
+        return len(query_texts)
+
+
+class ChromaWriteBatcher():
+    """
+    Collects chunk records per collection and writes them with one upsert per batch.
+    Each Chroma write is a SQLite commit plus an HNSW index update, so writing chunk by
+    chunk dominates ingestion time once the embeddings come from the cache.
+    The batch size is set by `write_batch_size` in config.yaml, the sidecar format by
+    `sidecar_format` and the precision of the stored embeddings by `storage_precision`
+    (see EmbeddingStorage and ColumnarStore). With `lexical_index` the chunks are also
+    added to the BM25 index of their collection (see LexicalIndex).
+    """
+    def __init__(self, chroma: ChromaDB, collections: dict, batch_size=None):
+        self.chroma = chroma
+        self.collections = collections
+        self.batch_size = batch_size or cfg.get('embedding', {}).get('write_batch_size') or 1000
+        self.precision = EmbeddingStorage.storage_precision()
+        self.sidecar_format = ChromaDB.sidecar_format()
+        self.lexical_index = bool(cfg.get('embedding', {}).get('lexical_index'))
+        self.pending = {}
+        self.stores = {}
+
+    def __repr__(self):
+        return f"{__class__.__name__}(batch_size={self.batch_size})"
+
+    def add(self, record, embedding):
+        collection_name = record["collection"]
+        batch = self.pending.setdefault(collection_name, [])
+        batch.append((record, embedding))
+        if len(batch) >= self.batch_size:
+            self._flush_collection(collection_name)
+
+    def flush(self):
+        for collection_name in list(self.pending):
+            self._flush_collection(collection_name)
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+    def _get_store(self, collection_name):
+        store = self.stores.get(collection_name)
+        if store is None:
+            folder = os.path.join(self.chroma.chroma_persist_dir, collection_name)
+            if not ColumnarStore.exists(folder) and any(name.endswith(".json") for name in os.listdir(folder)):
+                # chunks stored as JSON before the format was switched have to be part of the store
+                migrated = ColumnarStore.migrate_folder(folder, self.precision)
+                print(f"Migrated {migrated} JSON sidecars of {collection_name} to the columnar format")
+            store = self.stores[collection_name] = ColumnarStore(folder)
+        return store
+
+    def _flush_collection(self, collection_name):
+        batch = self.pending.pop(collection_name, [])
+        if not batch:
+            return
+
+        created_at = datetime.utcnow().isoformat() + "Z"
+        if self.sidecar_format == "columnar":
+            self._get_store(collection_name).append([{
+                "id": record["metadata"]["id"],
+                "chunk_index": record["chunk_index"],
+                "text": record["text"],
+                "metadata": record["metadata"],
+                "created_at": created_at,
+            } for record, _ in batch], [embedding for _, embedding in batch], self.precision)
+        else:
+            for record, embedding in batch:
+                metadata = record["metadata"]
+                json_record = {
+                    "id": metadata["id"],
+                    "chunk_index": record["chunk_index"],
+                    "text": record["text"],
+                    "embedding": EmbeddingStorage.encode(embedding, self.precision),
+                    "metadata": metadata,
+                    "created_at": created_at,
+                }
+                json_path = os.path.join(self.chroma.chroma_persist_dir, collection_name, f"{metadata['id']}.json")
+                with open(json_path, "w", encoding="utf-8") as f:
+                    json.dump(json_record, f, ensure_ascii=False)
+
+        self.collections[collection_name].upsert(
+            ids=[record["metadata"]["id"] for record, _ in batch],
+            embeddings=[embedding for _, embedding in batch],
+            documents=[record["text"] for record, _ in batch],
+            metadatas=[record["metadata"] for record, _ in batch]  # type: ignore
+        )
+        NumpyVectorIndex.invalidate(self.chroma.chroma_persist_dir, collection_name)
+        if self.lexical_index:
+            LexicalIndex.add(self.chroma.chroma_persist_dir, collection_name, [
+                {"id": record["metadata"]["id"], "text": record["text"], "metadata": record["metadata"]} for record, _ in batch
+            ])
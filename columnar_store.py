@@ -0,0 +1,275 @@
+import os
+import json
+import mmap
+import sqlite3
+import struct
+import threading
+import numpy as np
+from embedding_storage import EmbeddingStorage
+
+
+class ColumnarStore():
+    """
+    Columnar on-disk format for the chunks of one collection, an alternative to one JSON
+    sidecar per chunk. The files live in the collection's sidecar folder:
+
+    embeddings.npy  - embedding matrix (one row per chunk) in storage precision, opened with mmap_mode
+    texts.bin       - utf-8 texts of all chunks back to back
+    chunks.sqlite3  - one row per chunk: id, matrix row, text offset and length, chunk_index,
+                      metadata (JSON), int8 scale factor, created_at and a deleted flag
+
+    Chunks are only appended; deleted chunks are flagged and dropped by compact(). The .npy
+    header has a fixed size, so appending rows only rewrites the shape in place. Readers
+    see a chunk once its table row is committed, which happens after its embedding and text
+    are written, so any process can open the store while the ingestion appends to it.
+    """
+    embeddings_file = "embeddings.npy"
+    texts_file = "texts.bin"
+    table_file = "chunks.sqlite3"
+    # fixed .npy header size (magic, version, header length, padded dict), a multiple of 64
+    header_size = 128
+    _magic = b"\x93NUMPY\x01\x00"
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.embeddings_path = os.path.join(folder, self.embeddings_file)
+        self.texts_path = os.path.join(folder, self.texts_file)
+        self.table_path = os.path.join(folder, self.table_file)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def __repr__(self):
+        return f"{__class__.__name__}('{self.folder}')"
+
+    @classmethod
+    def exists(cls, folder: str):
+        return os.path.exists(os.path.join(folder, cls.table_file))
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._connection = sqlite3.connect(self.table_path, check_same_thread=False)
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT PRIMARY KEY,
+                    row INTEGER NOT NULL,
+                    text_offset INTEGER NOT NULL,
+                    text_length INTEGER NOT NULL,
+                    chunk_index INTEGER,
+                    metadata TEXT,
+                    scale REAL,
+                    created_at TEXT,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            self._connection.commit()
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _write_header(self, f, dtype, rows: int, dimensions: int):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": (rows, dimensions),
+        }).encode("latin1")
+        padding = self.header_size - len(self._magic) - 2 - len(header) - 1
+        f.seek(0)
+        f.write(self._magic + struct.pack("<H", len(header) + padding + 1) + header + b" " * padding + b"\n")
+
+    def _read_header(self):
+        """Return (dtype, rows, dimensions) of the embedding matrix, None if there is none yet."""
+        if not os.path.exists(self.embeddings_path):
+            return None
+        with open(self.embeddings_path, "rb") as f:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        return dtype, shape[0], shape[1]
+
+    def append(self, records, embeddings, precision: str = None):
+        """
+        Append chunk records (dicts with id, chunk_index, text, metadata, created_at) with their
+        embeddings. Chunks that are already stored are skipped, deleted ones are restored.
+        The precision is fixed when the matrix is created (default: storage_precision).
+        """
+        with self._lock:
+            connection = self._connect()
+            ids = [record["id"] for record in records]
+            existing = {}
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                placeholders = ",".join("?" for _ in batch)
+                existing.update(connection.execute(f"SELECT id, deleted FROM chunks WHERE id IN ({placeholders})", batch).fetchall())
+
+            restored = [id for id in dict.fromkeys(ids) if existing.get(id) == 1]
+            new_items = {}
+            for record, embedding in zip(records, embeddings):
+                if record["id"] not in existing and record["id"] not in new_items:
+                    new_items[record["id"]] = (record, embedding)
+
+            if new_items:
+                header = self._read_header()
+                if header is None:
+                    precision = precision or EmbeddingStorage.storage_precision()
+                    rows = 0
+                else:
+                    dtype, rows, _ = header
+                    precision = dtype.name
+                values, scales = EmbeddingStorage.quantize([embedding for _, embedding in new_items.values()], precision)
+
+                with open(self.embeddings_path, "r+b" if header is not None else "w+b") as f:
+                    if header is None:
+                        self._write_header(f, values.dtype, 0, values.shape[1])
+                    elif values.shape[1] != header[2]:
+                        raise ValueError(f"{self.folder} holds {header[2]}-dimensional embeddings, got {values.shape[1]}")
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.ascontiguousarray(values).tobytes())
+                    f.flush()
+                    self._write_header(f, values.dtype, rows + len(values), values.shape[1])
+
+                table_rows = []
+                with open(self.texts_path, "ab") as f:
+                    offset = f.tell()
+                    for i, (record, _) in enumerate(new_items.values()):
+                        text = (record.get("text") or "").encode("utf-8")
+                        f.write(text)
+                        table_rows.append((
+                            record["id"],
+                            rows + i,
+                            offset,
+                            len(text),
+                            record.get("chunk_index"),
+                            json.dumps(record.get("metadata"), ensure_ascii=False),
+                            float(scales[i][0]) if scales is not None else None,
+                            record.get("created_at"),
+                        ))
+                        offset += len(text)
+
+                connection.executemany(
+                    "INSERT INTO chunks (id, row, text_offset, text_length, chunk_index, metadata, scale, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    table_rows
+                )
+            if restored:
+                connection.executemany("UPDATE chunks SET deleted = 0 WHERE id = ?", [(id,) for id in restored])
+            connection.commit()
+            return len(new_items) + len(restored)
+
+    def delete(self, ids):
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(id,) for id in ids])
+            connection.commit()
+
+    def load(self):
+        """
+        Open the store for reading. Returns a dict with the matrix (memory-mapped, all rows
+        incl. deleted ones), the matrix rows of the active chunks with their ids, text
+        offsets/lengths, metadata JSON and int8 scales, and a texts buffer.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT row, id, text_offset, text_length, metadata, scale FROM chunks WHERE deleted = 0 ORDER BY row"
+            ).fetchall()
+        header = self._read_header()
+        if header is None or not rows:
+            return {"matrix": np.zeros((0, 0), dtype=np.float32), "rows": np.zeros(0, dtype=np.int64), "ids": [],
+                    "text_offsets": [], "text_lengths": [], "metadata": [], "scales": None, "texts": b""}
+
+        matrix = np.load(self.embeddings_path, mmap_mode="r")
+        texts = b""
+        if os.path.getsize(self.texts_path):
+            with open(self.texts_path, "rb") as f:
+                texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return {
+            "matrix": matrix,
+            "rows": np.array([row[0] for row in rows], dtype=np.int64),
+            "ids": [row[1] for row in rows],
+            "text_offsets": [row[2] for row in rows],
+            "text_lengths": [row[3] for row in rows],
+            "metadata": [row[4] for row in rows],
+            "scales": np.array([row[5] for row in rows], dtype=np.float32) if matrix.dtype == np.int8 else None,
+            "texts": texts,
+        }
+
+    def iter_records(self):
+        """Yield (record, embedding) for all active chunks, embeddings as float32 arrays."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, row, text_offset, text_length, chunk_index, metadata, scale, created_at FROM chunks WHERE deleted = 0 ORDER BY row"
+            ).fetchall()
+        if not rows:
+            return
+        matrix = np.load(self.embeddings_path, mmap_mode="r")
+        with open(self.texts_path, "rb") as f:
+            texts = f.read()
+        for id, row, text_offset, text_length, chunk_index, metadata, scale, created_at in rows:
+            record = {
+                "id": id,
+                "chunk_index": chunk_index,
+                "text": texts[text_offset:text_offset + text_length].decode("utf-8"),
+                "metadata": json.loads(metadata) if metadata else None,
+                "created_at": created_at,
+            }
+            yield record, EmbeddingStorage.dequantize(matrix[row], scale)
+
+    def compact(self):
+        """Rewrite the store without deleted chunks."""
+        header = self._read_header()
+        if header is None:
+            return
+        compacted = ColumnarStore(self.folder + ".compacting")
+        for name in (self.embeddings_file, self.texts_file, self.table_file):
+            path = os.path.join(compacted.folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+        records, embeddings = [], []
+        for record, embedding in self.iter_records():
+            records.append(record)
+            embeddings.append(embedding)
+            if len(records) >= 1000:
+                compacted.append(records, embeddings, header[0].name)
+                records, embeddings = [], []
+        if records:
+            compacted.append(records, embeddings, header[0].name)
+        compacted.close()
+        self.close()
+        for name in (self.embeddings_file, self.texts_file, self.table_file):
+            source = os.path.join(compacted.folder, name)
+            if os.path.exists(source):
+                os.replace(source, os.path.join(self.folder, name))
+            elif os.path.exists(os.path.join(self.folder, name)):
+                os.remove(os.path.join(self.folder, name))
+        os.rmdir(compacted.folder)
+
+    @classmethod
+    def migrate_folder(cls, folder: str, precision: str = None, remove_json: bool = False, batch_size: int = 1000):
+        """Append the JSON sidecars of a collection folder to its columnar store."""
+        store = cls(folder)
+        json_files = sorted(name for name in os.listdir(folder) if name.endswith(".json"))
+        migrated = 0
+        for start in range(0, len(json_files), batch_size):
+            records, embeddings = [], []
+            for name in json_files[start:start + batch_size]:
+                with open(os.path.join(folder, name), "r", encoding="utf-8") as f:
+                    record = json.load(f)
+                embeddings.append(EmbeddingStorage.decode(record.pop("embedding")))
+                records.append(record)
+            migrated += store.append(records, embeddings, precision)
+        store.close()
+        if remove_json:
+            for name in json_files:
+                os.remove(os.path.join(folder, name))
+        return migrated
+
+    @classmethod
+    def migrate(cls, persist_dir: str, precision: str = None, remove_json: bool = False):
+        """Convert the JSON sidecars of all collections of a persist directory (e.g. chroma_db_8000_800)."""
+        for name in sorted(os.listdir(persist_dir)):
+            folder = os.path.join(persist_dir, name)
+            if name.endswith("_embeddings") and os.path.isdir(folder):
+                migrated = cls.migrate_folder(folder, precision, remove_json)
+                print(f"{folder}: {migrated} chunks migrated to the columnar format")
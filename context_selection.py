@@ -0,0 +1,110 @@
+import yaml
+import numpy as np
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+
+class ContextSelector():
+    """
+    Post-retrieval selection of the chunks that go into the prompt.
+
+    With a large chunk_overlap neighbouring chunks of a document share long spans of text,
+    so the closest chunks of a query are often near-copies of each other. select() picks
+    the final chunks from a larger candidate list by maximal marginal relevance (MMR): each
+    next chunk is the one most similar to the query minus its similarity to the chunks
+    already picked, weighted by `mmr_lambda`. Picked chunks of the same file whose texts
+    overlap are then stitched into one passage, so the shared span is only sent once.
+    """
+    # shortest shared span (characters) that counts as chunk overlap when stitching
+    min_overlap = 32
+
+    @staticmethod
+    def mmr(query_embedding, candidate_embeddings, n: int, lambda_mult: float = 0.5):
+        """Positions of the n candidates picked by maximal marginal relevance (cosine similarity)."""
+        candidates = np.asarray(candidate_embeddings, dtype=np.float32)
+        if len(candidates) <= 1 or n <= 0:
+            return list(range(min(n, len(candidates))))
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norms = np.linalg.norm(candidates, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        candidates = candidates / norms
+        relevance = candidates @ (query / (np.linalg.norm(query) or 1.0))
+        similarity = candidates @ candidates.T
+
+        selected = []
+        # highest similarity of every candidate to the chunks picked so far
+        redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+        available = np.ones(len(candidates), dtype=bool)
+        for _ in range(min(n, len(candidates))):
+            scores = lambda_mult * relevance - (1 - lambda_mult) * (redundancy if selected else 0.0)
+            scores = np.where(available, scores, -np.inf)
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, similarity[best])
+        return selected
+
+    @classmethod
+    def overlap(cls, left: str, right: str):
+        """Length of the longest end of `left` that `right` starts with, 0 if shorter than min_overlap."""
+        probe = right[:cls.min_overlap]
+        if len(probe) < cls.min_overlap:
+            return 0
+        start = left.find(probe, max(0, len(left) - len(right)))
+        while start != -1:
+            if right.startswith(left[start:]):
+                return len(left) - start
+            start = left.find(probe, start + 1)
+        return 0
+
+    @classmethod
+    def _merge(cls, first, second):
+        """Stitched entry of two retrieved chunks, None if their texts do not overlap."""
+        first_text, second_text = first["document"] or "", second["document"] or ""
+        first_ids, second_ids = first.get("ids", [first["id"]]), second.get("ids", [second["id"]])
+        if second_text in first_text:
+            text, ids = first_text, first_ids + second_ids
+        elif first_text in second_text:
+            text, ids = second_text, second_ids + first_ids
+        elif (shared := cls.overlap(first_text, second_text)):
+            text, ids = first_text + second_text[shared:], first_ids + second_ids
+        elif (shared := cls.overlap(second_text, first_text)):
+            text, ids = second_text + first_text[shared:], second_ids + first_ids
+        else:
+            return None
+        best = first if first["distance"] <= second["distance"] else second
+        return {**best, "document": text, "ids": ids}
+
+    @classmethod
+    def stitch(cls, results):
+        """
+        Merge retrieved chunks of the same file whose texts overlap (neighbouring chunks).
+        Stitched entries keep the distance and metadata of their best-ranked chunk and list
+        the ids of all merged chunks in text order under "ids".
+        """
+        stitched = []
+        for entry in results:
+            file_name = (entry.get("metadata") or {}).get("file_name")
+            while file_name is not None:
+                for position, other in enumerate(stitched):
+                    if other["collection"] == entry["collection"] and (other.get("metadata") or {}).get("file_name") == file_name:
+                        merged = cls._merge(other, entry)
+                        if merged is not None:
+                            # the merged passage may now also overlap another chunk of the file
+                            del stitched[position]
+                            entry = merged
+                            break
+                else:
+                    break
+            stitched.append(entry)
+        return sorted(stitched, key=lambda entry: entry["distance"])
+
+    @classmethod
+    def select(cls, query_embedding, results, candidate_embeddings, top_n_entries: int):
+        """Pick top_n_entries of the retrieved candidates by MMR and stitch overlapping ones."""
+        if len(results) > top_n_entries:
+            lambda_mult = cfg.get('embedding', {}).get('mmr_lambda')
+            picked = cls.mmr(query_embedding, candidate_embeddings, top_n_entries, 0.5 if lambda_mult is None else lambda_mult)
+            results = [results[i] for i in sorted(picked)]
+        return cls.stitch(results)
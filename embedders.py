@@ -0,0 +1,217 @@
+import os
+import time
+import hashlib
+import threading
+import yaml
+import numpy as np
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+
+class Embedder():
+    """
+    Interface of the embedding backends behind ChromaDB.create_vector_embeddings.
+    embed() turns a list of texts into one embedding (list of floats) per text, in input
+    order. model_name and dimensions identify the vectors in the embedding caches, so
+    embeddings of different backends are never mixed up.
+    """
+    model_name = None
+    dimensions = None
+    provider = None
+    # True if embed() records its requests with CallTracker itself, otherwise
+    # ChromaDB.create_vector_embeddings records every embed() call
+    records_calls = False
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}('{self.model_name}')"
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+    def expected_dimensions(self):
+        """Length of the produced embeddings, None if it is only known after the first call."""
+        return self.dimensions
+
+    def cache_key(self):
+        """(model, dimensions) under which the embeddings are cached."""
+        return self.model_name, self.dimensions
+
+
+class OpenAIEmbedder(Embedder):
+    """Embeddings from the OpenAI API, packed into as few requests as the endpoint limits allow."""
+    # output size of the embedding models if no `dimensions` are configured
+    default_dimensions = {
+        "text-embedding-3-small": 1536,
+        "text-embedding-3-large": 3072,
+        "text-embedding-ada-002": 1536,
+    }
+    provider = "openAI"
+    # every request is recorded with its token usage
+    records_calls = True
+
+    def __init__(self, model_name: str, dimensions=None):
+        self.model_name = model_name
+        # only text-embedding-3-* models accept a reduced output size
+        self.dimensions = dimensions
+
+    def expected_dimensions(self):
+        return self.dimensions or self.default_dimensions.get(self.model_name)
+
+    def embed(self, texts):
+        from call_tracker import CallTracker
+        from llm_handler import LLMClients
+        from request_scheduler import RequestScheduler
+        from token_handler import batch_texts, count_tokens
+
+        # the process-wide OpenAI client (connection pool, timeout, no client-side retries)
+        client = LLMClients.openai()
+        extra_args = {"dimensions": self.dimensions} if self.dimensions else {}
+
+        # one request per batch, see max_batch_size / max_batch_tokens in config.yaml
+        embeddings = []
+        counts_tokens = RequestScheduler.limiter("openAI", self.model_name).counts_tokens
+        for batch in batch_texts(texts):
+            attempt = {}
+
+            def send():
+                start = time.perf_counter()
+                response = client.embeddings.create(
+                    input=batch,
+                    model=self.model_name,
+                    **extra_args
+                )
+                attempt["latency"] = time.perf_counter() - start
+                return response
+            # waits for the rate limits of the model and retries transient errors
+            started = time.perf_counter()
+            response = RequestScheduler.call("openAI", self.model_name, sum(count_tokens(text) for text in batch) if counts_tokens else 0, send)
+            CallTracker.record(
+                "embedding", "openAI", self.model_name, attempt["latency"],
+                usage=CallTracker.usage(response.usage),
+                wait_time=max(0.0, time.perf_counter() - started - attempt["latency"]),
+            )
+            # the API returns one item per input, tagged with its position in the batch
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return embeddings
+
+
+class OnnxEmbedder(Embedder):
+    """
+    Local sentence-embedding model (e.g. an exported all-MiniLM or e5 model) run with
+    onnxruntime on CPU threads. Texts are tokenized with the model's tokenizer.json,
+    embedded in batches of similar length (little padding) and mean-pooled over the
+    attention mask unless the model already returns pooled vectors; the embeddings are
+    L2-normalized.
+    """
+    provider = "onnx"
+
+    def __init__(self, model_path: str, tokenizer_path: str = None, batch_size: int = 32, max_length: int = 512, threads=None):
+        self.model_path = model_path
+        self.tokenizer_path = tokenizer_path or os.path.join(os.path.dirname(model_path), "tokenizer.json")
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.threads = threads
+        self.model_name = f"onnx:{os.path.basename(os.path.dirname(os.path.abspath(model_path)))}/{os.path.basename(model_path)}"
+        self.session = None
+        self.tokenizer = None
+        self._lock = threading.Lock()
+
+    def cache_key(self):
+        # the output size is fixed by the model file
+        return self.model_name, None
+
+    def _load(self):
+        if self.session is None:
+            with self._lock:
+                if self.session is None:
+                    import onnxruntime
+                    from tokenizers import Tokenizer
+
+                    options = onnxruntime.SessionOptions()
+                    if self.threads:
+                        options.intra_op_num_threads = self.threads
+                    tokenizer = Tokenizer.from_file(self.tokenizer_path)
+                    tokenizer.enable_truncation(max_length=self.max_length)
+                    tokenizer.enable_padding()
+                    self.tokenizer = tokenizer
+                    session = onnxruntime.InferenceSession(self.model_path, sess_options=options, providers=["CPUExecutionProvider"])
+                    self.input_names = {model_input.name for model_input in session.get_inputs()}
+                    self.session = session
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        output = self.session.run(None, {name: value for name, value in feeds.items() if name in self.input_names})[0]
+        if output.ndim == 3:
+            # token embeddings -> mean over the non-padding tokens
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (output / norms).astype(np.float32)
+
+    def embed(self, texts):
+        self._load()
+        # batches of similar length need little padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            for position, embedding in zip(positions, self._embed_batch([texts[i] for i in positions])):
+                embeddings[position] = embedding.tolist()
+        if embeddings and self.dimensions is None:
+            self.dimensions = len(embeddings[0])
+        return embeddings
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic offline stand-in for tests and dry runs: the words of a text (see
+    LexicalIndex.tokenize) are hashed into a fixed number of signed buckets and the
+    vector is L2-normalized. Texts sharing words get similar vectors; no model, no network.
+    """
+    provider = "hashing"
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+        self.model_name = f"hashing-{dimensions}"
+
+    def embed(self, texts):
+        from lexical_index import LexicalIndex
+
+        embeddings = []
+        for text in texts:
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+            for term in LexicalIndex.tokenize(text):
+                digest = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+                vector[digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector /= norm
+            embeddings.append(vector.tolist())
+        return embeddings
+
+
+def create_embedder():
+    """Embedder selected by `embedder` in the embedding section of config.yaml."""
+    embedding_cfg = cfg.get('embedding', {})
+    embedder = (embedding_cfg.get('embedder') or "openai").lower()
+    if embedder == "openai":
+        return OpenAIEmbedder(embedding_cfg.get('openAI_embedding_model'), embedding_cfg.get('dimensions'))
+    elif embedder == "onnx":
+        if not embedding_cfg.get('onnx_model_path'):
+            raise ValueError("embedder onnx requires onnx_model_path")
+        return OnnxEmbedder(
+            embedding_cfg.get('onnx_model_path'),
+            batch_size=embedding_cfg.get('onnx_batch_size') or 32,
+            max_length=embedding_cfg.get('onnx_max_length') or 512,
+            threads=embedding_cfg.get('onnx_threads'),
+        )
+    elif embedder == "hashing":
+        return HashingEmbedder(embedding_cfg.get('hashing_dimensions') or 256)
+    raise ValueError(f"Unknown embedder: {embedder}")
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from datetime import datetime
+
+
+class EmbeddingCache():
+    """
+    Persistent, content-addressed store for chunk embeddings.
+
+    Entries are keyed by (chunk hash, embedding model, dimensions), so a chunk is only
+    sent to the embedding API again if its text, the model or the output size changes.
+    Embeddings are stored as packed float32 blobs in a single SQLite file.
+    """
+    # SQLite limits the number of host parameters per statement
+    _max_query_parameters = 500
+    # table of the cached embeddings and the column of their content hash
+    table = "embeddings"
+    key_column = "chunk_hash"
+
+    def __init__(self, path: str):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._create_schema()
+        self.connection.commit()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}('{self.path}')"
+
+    def _create_schema(self):
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                chunk_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                embedding BLOB NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (chunk_hash, model, dimensions)
+            )"""
+        )
+
+    @staticmethod
+    def _encode(embedding):
+        return array('f', embedding).tobytes()
+
+    @staticmethod
+    def _decode(blob):
+        values = array('f')
+        values.frombytes(blob)
+        return values.tolist()
+
+    def _select(self, hashes, model: str, dimensions=None):
+        """Embeddings of the given hashes found in the table; the caller holds the lock."""
+        found = {}
+        for start in range(0, len(hashes), self._max_query_parameters):
+            batch = hashes[start:start + self._max_query_parameters]
+            placeholders = ",".join("?" for _ in batch)
+            rows = self.connection.execute(
+                f"SELECT {self.key_column}, embedding FROM {self.table} WHERE model = ? AND dimensions = ? AND {self.key_column} IN ({placeholders})",
+                [model, dimensions or 0, *batch]
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = self._decode(blob)
+        return found
+
+    def get_many(self, chunk_hashes, model: str, dimensions=None):
+        """Return a dict chunk_hash -> embedding for all hashes found in the cache."""
+        with self._lock:
+            return self._select(list(dict.fromkeys(chunk_hashes)), model, dimensions)
+
+    def put_many(self, embeddings: dict, model: str, dimensions=None):
+        """Store a dict chunk_hash -> embedding."""
+        created_at = datetime.utcnow().isoformat() + "Z"
+        with self._lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (chunk_hash, model, dimensions, embedding, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(chunk_hash, model, dimensions or 0, self._encode(embedding), created_at) for chunk_hash, embedding in embeddings.items()]
+            )
+            self.connection.commit()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class QueryEmbeddingCache(EmbeddingCache):
+    """
+    Persistent LRU cache for the embeddings of retrieval queries.
+
+    Entries are keyed by (query hash, embedding model, dimensions) like the chunk cache,
+    but every hit refreshes the entry's last use and the least recently used entries are
+    evicted once the cache holds more than `max_entries`. Hits and misses are counted so
+    that the hit rate of a benchmark sweep can be reported.
+    """
+    table = "query_embeddings"
+    key_column = "query_hash"
+
+    def __init__(self, path: str, max_entries=None):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path)
+
+    def _create_schema(self):
+        # like the chunk cache, with the last use instead of the creation time
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS query_embeddings (
+                query_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (query_hash, model, dimensions)
+            )"""
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)")
+
+    def get_many(self, query_hashes, model: str, dimensions=None):
+        """Return a dict query_hash -> embedding for all hashes found and mark them as used."""
+        query_hashes = list(dict.fromkeys(query_hashes))
+        with self._lock:
+            found = self._select(query_hashes, model, dimensions)
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE query_embeddings SET last_used = ? WHERE query_hash = ? AND model = ? AND dimensions = ?",
+                    [(now, query_hash, model, dimensions or 0) for query_hash in found]
+                )
+                self.connection.commit()
+            self.hits += len(found)
+            self.misses += len(query_hashes) - len(found)
+        return found
+
+    def put_many(self, embeddings: dict, model: str, dimensions=None):
+        """Store a dict query_hash -> embedding and evict the least recently used entries."""
+        now = time.time()
+        with self._lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO query_embeddings (query_hash, model, dimensions, embedding, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(query_hash, model, dimensions or 0, self._encode(embedding), now) for query_hash, embedding in embeddings.items()]
+            )
+            if self.max_entries:
+                self.connection.execute(
+                    """DELETE FROM query_embeddings WHERE rowid IN (
+                        SELECT rowid FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )""",
+                    [self.max_entries]
+                )
+            self.connection.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+            }
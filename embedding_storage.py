@@ -0,0 +1,139 @@
+import base64
+import yaml
+import numpy as np
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+
+class EmbeddingStorage():
+    """
+    Reduced-precision encoding of stored embeddings.
+
+    float32 keeps the plain float list of the original sidecar format. float16 halves the
+    size of a vector, int8 stores symmetric per-vector quantized values plus one scale
+    factor and needs a quarter of the float32 size. Quantized embeddings are encoded as
+    {"precision", "data" (base64), "scale"}; decode() accepts both forms, so sidecars
+    written with different settings can be read side by side.
+    The precision is set by `storage_precision` in config.yaml; Chroma itself always
+    keeps float32 vectors.
+    """
+    precisions = ("float32", "float16", "int8")
+
+    @classmethod
+    def storage_precision(cls):
+        precision = cfg.get('embedding', {}).get('storage_precision') or "float32"
+        if precision not in cls.precisions:
+            raise ValueError(f"Unknown storage precision: {precision}")
+        return precision
+
+    @staticmethod
+    def bytes_per_vector(dimensions: int, precision: str):
+        if precision == "int8":
+            # values plus the float32 scale factor
+            return dimensions + 4
+        return dimensions * np.dtype(precision).itemsize
+
+    @staticmethod
+    def quantize(embeddings, precision: str):
+        """
+        Convert a matrix (one embedding per row) to the given precision.
+        Returns (values, scales); scales is None unless the precision is int8.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if precision == "float32":
+            return embeddings, None
+        if precision == "float16":
+            return embeddings.astype(np.float16), None
+        if precision == "int8":
+            scales = np.abs(embeddings).max(axis=-1, keepdims=True) / 127.0
+            scales[scales == 0] = 1.0
+            values = np.clip(np.rint(embeddings / scales), -127, 127).astype(np.int8)
+            return values, scales.astype(np.float32)
+        raise ValueError(f"Unknown storage precision: {precision}")
+
+    @staticmethod
+    def dequantize(values, scales=None):
+        values = np.asarray(values).astype(np.float32)
+        if scales is not None:
+            values *= scales
+        return values
+
+    @classmethod
+    def encode(cls, embedding, precision: str = None):
+        """Encode a single embedding for a JSON sidecar."""
+        precision = precision or cls.storage_precision()
+        if precision == "float32":
+            return [float(value) for value in embedding]
+        values, scales = cls.quantize(embedding, precision)
+        encoded = {
+            "precision": precision,
+            "data": base64.b64encode(values.tobytes()).decode("ascii"),
+        }
+        if scales is not None:
+            encoded["scale"] = float(scales[0])
+        return encoded
+
+    @staticmethod
+    def decode(stored):
+        """Return a stored embedding (float list or encoded dict) as float32 array."""
+        if not isinstance(stored, dict):
+            return np.asarray(stored, dtype=np.float32)
+        values = np.frombuffer(base64.b64decode(stored["data"]), dtype=np.dtype(stored["precision"]))
+        values = values.astype(np.float32)
+        if "scale" in stored:
+            values *= stored["scale"]
+        return values
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    @classmethod
+    def _top_k(cls, queries, matrix, k, exclude=None):
+        scores = cls._normalize(queries) @ cls._normalize(matrix).T
+        if exclude is not None:
+            # a query taken from the index would otherwise always find itself
+            scores[np.arange(len(exclude)), exclude] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return [set(row) for row in top]
+
+    @classmethod
+    def recall_report(cls, embeddings, k: int = 10, n_queries: int = 200, precisions=None, dimensions=None, seed: int = 0):
+        """
+        Compare reduced storage against the full-precision index.
+
+        Stored embeddings serve as queries (full precision, as a query embedding would be)
+        and their cosine top-k neighbours in the reduced index are compared with the ones
+        in the full index. `dimensions` lists reduced output sizes to evaluate as well;
+        they are simulated by truncating and re-normalizing the stored vectors, which is
+        what the `dimensions` parameter of the text-embedding-3 models returns.
+        Returns one row per (dimensions, precision) with recall@k and the size of the index.
+        """
+        full = np.asarray(embeddings, dtype=np.float32)
+        n_vectors, full_dimensions = full.shape
+        if n_vectors < 2:
+            return []
+        k = min(k, n_vectors - 1)
+        precisions = precisions or cls.precisions
+        rng = np.random.default_rng(seed)
+        query_rows = rng.choice(n_vectors, size=min(n_queries, n_vectors), replace=False)
+
+        reference = cls._top_k(full[query_rows], full, k, exclude=query_rows)
+
+        report = []
+        for reduced_dimensions in [None] + [d for d in (dimensions or []) if d < full_dimensions]:
+            index = full if reduced_dimensions is None else cls._normalize(full[:, :reduced_dimensions])
+            for precision in precisions:
+                reduced = cls.dequantize(*cls.quantize(index, precision))
+                found = cls._top_k(index[query_rows], reduced, k, exclude=query_rows)
+                recall = float(np.mean([len(a & b) / k for a, b in zip(reference, found)]))
+                report.append({
+                    "dimensions": reduced_dimensions or full_dimensions,
+                    "precision": precision,
+                    f"recall@{k}": round(recall, 4),
+                    "index_bytes": n_vectors * cls.bytes_per_vector(reduced_dimensions or full_dimensions, precision),
+                })
+        return report
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+
+
+class IngestionManifest():
+    """
+    Record of the documentation files that are currently indexed.
+
+    For every source file the manifest keeps size, mtime, content hash and the ids of the
+    chunks that were stored for it. It is written next to the Chroma persist directory
+    (<chroma_persist_directory>_manifest.json) and lets the ingestion process only new or
+    changed files and remove the chunks of files that changed or disappeared.
+    """
+    def __init__(self, path: str, settings: dict, files: dict = None, previous_files: dict = None):
+        self.path = path
+        self.settings = settings
+        self.files = files if files is not None else {}
+        # entries of an index built with different settings, only needed to clean up its chunks
+        self.previous_files = previous_files if previous_files is not None else {}
+        # stat and hash of the changed files, taken when the changes were detected
+        self._detected = {}
+
+    def __repr__(self):
+        return f"{__class__.__name__}('{self.path}')"
+
+    @staticmethod
+    def manifest_path(chroma_persist_dir):
+        return os.path.normpath(chroma_persist_dir) + "_manifest.json"
+
+    @classmethod
+    def load(cls, chroma_persist_dir, settings: dict):
+        """
+        Load the manifest of the given persist directory.
+        If the ingestion settings (chunking, embedding model, ...) differ from the ones the
+        index was built with, all files are treated as new.
+        """
+        path = cls.manifest_path(chroma_persist_dir)
+        if not os.path.exists(path):
+            return cls(path, settings)
+        with open(path, "r", encoding="utf-8") as f:
+            content = json.load(f)
+        if content.get("settings") != settings:
+            print("Ingestion settings changed, all files will be re-indexed")
+            return cls(path, settings, previous_files=content.get("files", {}))
+        return cls(path, settings, content.get("files", {}))
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "files": self.files}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def source_type(file_name):
+        if file_name.startswith("API_") and file_name.endswith(".json"):
+            return "API"
+        elif file_name.startswith("DB_") and file_name.endswith(".json"):
+            return "DB"
+        elif file_name.endswith(".txt"):
+            return "TXT"
+        return None
+
+    @staticmethod
+    def _hash_file(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def detect_changes(self, source_folder):
+        """
+        Compare the source folder with the manifest.
+        Returns (changed_files, removed_files): paths of new or modified files and paths
+        that are in the manifest but no longer exist.
+        Files whose size and mtime are unchanged are not read at all; files that were only
+        touched (same content hash) get their stat information refreshed.
+        """
+        changed_files = set()
+        current_files = set()
+        for root, dirs, files in os.walk(source_folder):
+            for file in files:
+                if self.source_type(file) is None:
+                    continue
+                file_path = os.path.normpath(os.path.join(root, file))
+                current_files.add(file_path)
+                stat = os.stat(file_path)
+                entry = self.files.get(file_path)
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                    continue
+                content_hash = self._hash_file(file_path)
+                if entry is not None and entry["sha256"] == content_hash:
+                    entry["size"] = stat.st_size
+                    entry["mtime"] = stat.st_mtime
+                    continue
+                changed_files.add(file_path)
+                self._detected[file_path] = (stat.st_size, stat.st_mtime, content_hash)
+
+        removed_files = (set(self.files) | set(self.previous_files)) - current_files
+        return changed_files, removed_files
+
+    def _previous_entry(self, file_path):
+        entry = self.files.get(file_path)
+        if entry is None:
+            entry = self.previous_files.get(file_path)
+        return entry
+
+    def update(self, chunk_ids_by_file: dict, removed_files):
+        """
+        Store the new chunk ids of the processed files and drop removed files.
+        Returns the ids that are no longer referenced by any file, grouped by source type,
+        so that they can be deleted from the collections.
+        """
+        candidates = {}
+        for file_path in list(chunk_ids_by_file) + list(removed_files):
+            entry = self._previous_entry(file_path)
+            if entry is not None:
+                candidates.setdefault(entry["source_type"], set()).update(entry["chunk_ids"])
+
+        for file_path in removed_files:
+            self.files.pop(file_path, None)
+            self.previous_files.pop(file_path, None)
+
+        for file_path, chunk_ids in chunk_ids_by_file.items():
+            if file_path in self._detected:
+                size, mtime, content_hash = self._detected.pop(file_path)
+            else:
+                stat = os.stat(file_path)
+                size, mtime, content_hash = stat.st_size, stat.st_mtime, self._hash_file(file_path)
+            self.previous_files.pop(file_path, None)
+            self.files[file_path] = {
+                "size": size,
+                "mtime": mtime,
+                "sha256": content_hash,
+                "source_type": self.source_type(os.path.basename(file_path)),
+                "chunk_ids": list(dict.fromkeys(chunk_ids)),
+            }
+
+        # the same chunk text can occur in several files, only delete ids nobody references anymore
+        referenced = {}
+        for entry in self.files.values():
+            referenced.setdefault(entry["source_type"], set()).update(entry["chunk_ids"])
+
+        stale_ids = {}
+        for source_type, ids in candidates.items():
+            stale = ids - referenced.get(source_type, set())
+            if stale:
+                stale_ids[source_type] = sorted(stale)
+        return stale_ids
@@ -0,0 +1,224 @@
+import os
+import json
+import queue
+import threading
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from token_handler import batch_texts
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+
+def chunk_api_file(api_file: dict):
+    """
+    Load one swagger spec and return its endpoint chunks as texts.
+    Runs in a worker process, so the spec never has to be sent between processes.
+    """
+    from system_documentation import APIDocumentation
+
+    with open(api_file['file_path'], 'r', encoding='utf-8') as f:
+        swagger_content = json.load(f)
+    documentation = APIDocumentation(
+        business_object_name=api_file['business_object_name'],
+        file_name=api_file['file_name'],
+        swagger_content=swagger_content,
+        file_path=api_file['file_path'],
+        register=False
+    )
+    return [APIDocumentation.render_chunk(chunk) for chunk in documentation.iter_swagger_chunks()]
+
+
+class IngestionPipeline():
+    """
+    Parallel ingestion of the system documentation.
+
+    Swagger specs are chunked in a process pool (CPU-bound $ref resolution). Finished files
+    are split, checked against the embedding cache and their missing chunks are put as
+    embedding batches on a bounded queue. A pool of embedding threads (I/O-bound API calls)
+    works off the queue and hands the results to a single writer thread that stores them
+    in Chroma in bulk upserts (ChromaWriteBatcher), so that the collections are only
+    written from one thread.
+    In streaming mode the specs are instead loaded one at a time in this process and their
+    chunks are fed into the queue as they are produced; each spec is released once it has
+    been processed, so memory stays flat regardless of the number of business objects.
+    Worker counts, queue size and the mode are configured in the `ingestion` section of config.yaml.
+    """
+    def __init__(self, chroma, chunk_workers=None, embedding_workers=None, queue_size=None, streaming=None):
+        ingestion_cfg = cfg.get('ingestion', {}) or {}
+        self.chroma = chroma
+        self.chunk_workers = chunk_workers or ingestion_cfg.get('chunk_workers') or os.cpu_count()
+        self.embedding_workers = embedding_workers or ingestion_cfg.get('embedding_workers') or 4
+        self.queue_size = queue_size or ingestion_cfg.get('queue_size') or 2 * self.embedding_workers
+        self.streaming = ingestion_cfg.get('streaming', False) if streaming is None else streaming
+        self.stream_buffer_size = ingestion_cfg.get('stream_buffer_size') or 16
+
+    def __repr__(self):
+        if self.streaming:
+            return f"{__class__.__name__}(streaming, embedding_workers={self.embedding_workers})"
+        return f"{__class__.__name__}(chunk_workers={self.chunk_workers}, embedding_workers={self.embedding_workers})"
+
+    def run(self, api_files, documents):
+        """
+        Index API specs (dicts with business_object_name, file_name and file_path, as returned
+        by APIDocumentation.find_api_json_files) and already loaded DB/TXT documents.
+        Returns the chunk ids per file path.
+        """
+        self.collections = self.chroma.get_collections(
+            [self.chroma.collection_name(source_type) for source_type in ("API", "DB", "TXT")]
+        )
+        self.chunk_ids_by_file = {}
+        self.seen = set()
+        self.errors = []
+        self.counts = {"stored": 0, "cached": 0, "embedded": 0}
+
+        self.embedding_queue = queue.Queue(maxsize=self.queue_size)
+        self.write_queue = queue.Queue()
+
+        embedding_threads = [
+            threading.Thread(target=self._embedding_worker, name=f"embedding-worker-{i}", daemon=True)
+            for i in range(self.embedding_workers)
+        ]
+        writer_thread = threading.Thread(target=self._writer, name="chroma-writer", daemon=True)
+        for thread in embedding_threads:
+            thread.start()
+        writer_thread.start()
+
+        try:
+            # cheap documents first, they keep the embedding workers busy while the specs are chunked
+            self._enqueue_documents(documents)
+
+            if self.streaming:
+                for api_file in api_files:
+                    self._stream_api_file(api_file)
+                    if self.errors:
+                        break
+            else:
+                self._chunk_in_processes(api_files)
+        finally:
+            for _ in embedding_threads:
+                self.embedding_queue.put(None)
+            for thread in embedding_threads:
+                thread.join()
+            self.write_queue.put(None)
+            writer_thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        print(f"Ingestion: {self.counts['stored']} chunks already stored, {self.counts['cached']} cached, {self.counts['embedded']} embedded")
+        return self.chunk_ids_by_file
+
+    def _chunk_in_processes(self, api_files):
+        with ProcessPoolExecutor(max_workers=self.chunk_workers) as executor:
+            futures = {executor.submit(chunk_api_file, api_file): api_file for api_file in api_files}
+            for future in as_completed(futures):
+                api_file = futures[future]
+                try:
+                    chunk_texts = future.result()
+                except Exception as e:
+                    print(f"[ERROR] Chunking {api_file['file_name']} failed: {e}")
+                    continue
+                print(f"Processing file: {api_file['file_name']} ({len(chunk_texts)} chunks)")
+                self._enqueue_documents([{
+                    "text": text,
+                    "file_name": api_file['file_name'],
+                    "file_path": api_file['file_path'],
+                    "business_object": api_file['business_object_name'],
+                    "source_type": "API",
+                } for text in chunk_texts], file_paths=[api_file['file_path']])
+                if self.errors:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+    def _stream_api_file(self, api_file):
+        from system_documentation import APIDocumentation
+
+        documentation = APIDocumentation.load_api_json_file(api_file)
+        if documentation is None:
+            return
+        print(f"Processing file: {api_file['file_name']}")
+        buffer = []
+        for chunk in documentation.iter_swagger_chunks():
+            buffer.append({
+                "text": APIDocumentation.render_chunk(chunk),
+                "file_name": api_file['file_name'],
+                "file_path": api_file['file_path'],
+                "business_object": api_file['business_object_name'],
+                "source_type": "API",
+            })
+            if len(buffer) >= self.stream_buffer_size:
+                self._enqueue_documents(buffer, file_paths=[api_file['file_path']])
+                buffer = []
+        self._enqueue_documents(buffer, file_paths=[api_file['file_path']])
+
+    def _enqueue_documents(self, documents, file_paths=None):
+        # register the files even if they produce no chunks, so their old chunks get removed
+        for file_path in file_paths or []:
+            self.chunk_ids_by_file.setdefault(file_path, [])
+
+        records, document_chunk_ids = self.chroma.split_documents(documents)
+        for document, chunk_ids in zip(documents, document_chunk_ids):
+            self.chunk_ids_by_file.setdefault(document["file_path"], []).extend(chunk_ids)
+        if not records:
+            return
+
+        pending_records, cached_embeddings, stored_count = self.chroma.select_pending_records(records, self.collections, self.seen)
+        self.counts["stored"] += stored_count
+
+        cached_records = [record for record in pending_records if record["metadata"]["id"] in cached_embeddings]
+        missing_records = [record for record in pending_records if record["metadata"]["id"] not in cached_embeddings]
+        self.counts["cached"] += len(cached_records)
+
+        if cached_records:
+            self.write_queue.put((cached_records, [cached_embeddings[record["metadata"]["id"]] for record in cached_records], False))
+
+        # one queue item per embedding request; put() blocks while all workers are busy
+        start = 0
+        for batch in batch_texts([record["text"] for record in missing_records]):
+            self.embedding_queue.put(missing_records[start:start + len(batch)])
+            start += len(batch)
+
+    def _embedding_worker(self):
+        while True:
+            batch = self.embedding_queue.get()
+            if batch is None:
+                break
+            if self.errors:
+                continue
+            try:
+                embeddings = self.chroma.create_vector_embeddings([record["text"] for record in batch])
+                self.write_queue.put((batch, embeddings, True))
+            except Exception as e:
+                self.errors.append(e)
+
+    def _writer(self):
+        from chroma_handler import ChromaWriteBatcher
+
+        embedding_model, dimensions = self.chroma.embedding_cache_key()
+        batcher = ChromaWriteBatcher(self.chroma, self.collections)
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                if not self.errors:
+                    try:
+                        batcher.flush()
+                    except Exception as e:
+                        self.errors.append(e)
+                break
+            if self.errors:
+                continue
+            records, embeddings, is_new = item
+            try:
+                if is_new:
+                    self.chroma.get_embedding_cache().put_many(
+                        {record["metadata"]["id"]: embedding for record, embedding in zip(records, embeddings)},
+                        embedding_model,
+                        dimensions
+                    )
+                    self.counts["embedded"] += len(records)
+                for record, embedding in zip(records, embeddings):
+                    batcher.add(record, embedding)
+            except Exception as e:
+                self.errors.append(e)
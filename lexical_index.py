@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import math
+import heapq
+import sqlite3
+import threading
+from collections import Counter
+from retrieval_router import MetadataFilter
+
+
+class LexicalIndex():
+    """
+    Local BM25 index over the chunks of one collection.
+
+    The ingestion adds every stored chunk (text, metadata and term frequencies) to
+    <persist_dir>/<collection>/lexical.sqlite3; for retrieval the table is loaded into an
+    in-memory inverted index once per process. Terms are lower-cased words and numbers;
+    identifiers like BankAccountUUID or CancelBankAccountEntry are indexed both as a whole
+    and split into their camel-case parts, so exact identifiers and their words match.
+    query() needs no embedding call and returns chromadb's result structure with the
+    negative BM25 score as distance.
+    """
+    table_file = "lexical.sqlite3"
+    k1 = 1.2
+    b = 0.75
+
+    # loaded indexes per (persist dir, collection), shared by all threads of the process
+    _indexes = {}
+    _lock = threading.Lock()
+
+    _word_pattern = re.compile(r"[A-Za-z0-9]+")
+    _camel_case_pattern = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+    def __init__(self, persist_dir: str, collection_name: str):
+        self.persist_dir = persist_dir
+        self.collection_name = collection_name
+        self.path = os.path.join(persist_dir, collection_name, self.table_file)
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.lengths = []
+        self.average_length = 0.0
+        self.postings = {}
+        # chunk positions per metadata filter
+        self._partitions = {}
+
+    def __repr__(self):
+        return f"{__class__.__name__}('{self.collection_name}', {len(self.ids)} chunks)"
+
+    @classmethod
+    def tokenize(cls, text: str):
+        terms = []
+        for word in cls._word_pattern.findall(text or ""):
+            terms.append(word.lower())
+            parts = cls._camel_case_pattern.findall(word)
+            if len(parts) > 1:
+                terms.extend(part.lower() for part in parts)
+        return terms
+
+    @classmethod
+    def _connect(cls, path):
+        connection = sqlite3.connect(path)
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                metadata TEXT,
+                length INTEGER NOT NULL,
+                terms TEXT NOT NULL
+            )"""
+        )
+        return connection
+
+    @classmethod
+    def add(cls, persist_dir: str, collection_name: str, records):
+        """Index chunk records (dicts with id, text and metadata); known ids are replaced."""
+        folder = os.path.join(persist_dir, collection_name)
+        os.makedirs(folder, exist_ok=True)
+        rows = []
+        for record in records:
+            term_counts = Counter(cls.tokenize(record["text"]))
+            rows.append((
+                record["id"],
+                record["text"],
+                json.dumps(record.get("metadata"), ensure_ascii=False),
+                sum(term_counts.values()),
+                json.dumps(term_counts, ensure_ascii=False),
+            ))
+        with cls._lock:
+            connection = cls._connect(os.path.join(folder, cls.table_file))
+            connection.executemany("INSERT OR REPLACE INTO chunks (id, text, metadata, length, terms) VALUES (?, ?, ?, ?, ?)", rows)
+            connection.commit()
+            connection.close()
+        cls.invalidate(persist_dir, collection_name)
+
+    @classmethod
+    def delete(cls, persist_dir: str, collection_name: str, ids):
+        path = os.path.join(persist_dir, collection_name, cls.table_file)
+        if not os.path.exists(path):
+            return
+        with cls._lock:
+            connection = cls._connect(path)
+            connection.executemany("DELETE FROM chunks WHERE id = ?", [(id,) for id in ids])
+            connection.commit()
+            connection.close()
+        cls.invalidate(persist_dir, collection_name)
+
+    @classmethod
+    def rebuild(cls, chroma, collection_names=None):
+        """Build the index of existing collections from the documents stored in Chroma."""
+        for collection_name in collection_names or chroma.shared_collection_names(chroma.chroma_persist_dir):
+            path = os.path.join(chroma.chroma_persist_dir, collection_name, cls.table_file)
+            if os.path.exists(path):
+                os.remove(path)
+            stored = chroma.get_collection(collection_name).get(include=["documents", "metadatas"])
+            cls.add(chroma.chroma_persist_dir, collection_name, [
+                {"id": id, "text": document or "", "metadata": metadata}
+                for id, document, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+            ])
+            print(f"Lexical index of {collection_name}: {len(stored['ids'])} chunks")
+
+    @classmethod
+    def shared(cls, persist_dir: str, collection_name: str):
+        """Loaded index of a collection, read from disk on first use."""
+        key = (persist_dir, collection_name)
+        index = cls._indexes.get(key)
+        if index is None:
+            with cls._lock:
+                index = cls._indexes.get(key)
+                if index is None:
+                    index = cls._indexes[key] = cls(persist_dir, collection_name).load()
+        return index
+
+    @classmethod
+    def invalidate(cls, persist_dir: str, collection_name: str):
+        with cls._lock:
+            cls._indexes.pop((persist_dir, collection_name), None)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        connection = self._connect(self.path)
+        rows = connection.execute("SELECT id, text, metadata, length, terms FROM chunks").fetchall()
+        connection.close()
+        for i, (id, text, metadata, length, terms) in enumerate(rows):
+            self.ids.append(id)
+            self.documents.append(text)
+            self.metadatas.append(metadata)
+            self.lengths.append(length)
+            for term, count in json.loads(terms).items():
+                self.postings.setdefault(term, []).append((i, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        return self
+
+    def count(self):
+        return len(self.ids)
+
+    def scores(self, query_text: str):
+        """BM25 score per chunk position for all chunks that contain a query term."""
+        n_chunks = len(self.ids)
+        scores = {}
+        # unique terms in query order, so that scores do not depend on the hash seed
+        for term in dict.fromkeys(self.tokenize(query_text)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, count in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average_length)
+                scores[i] = scores.get(i, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+    def _partition(self, where):
+        key = MetadataFilter.key(where)
+        partition = self._partitions.get(key)
+        if partition is None:
+            partition = self._partitions[key] = {
+                i for i, metadata in enumerate(self.metadatas)
+                if MetadataFilter.matches(json.loads(metadata) if metadata else None, where)
+            }
+        return partition
+
+    def query(self, query_texts, n_results: int = 10, where=None):
+        """
+        Top-n chunks per query text, optionally restricted by a metadata filter (Chroma `where`
+        syntax); returns ids, documents, metadatas and distances like chromadb.
+        """
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        partition = self._partition(where) if where else None
+        for query_text in query_texts:
+            scores = self.scores(query_text)
+            if partition is not None:
+                scores = {i: score for i, score in scores.items() if i in partition}
+            top = heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+            result["ids"].append([self.ids[i] for i, _ in top])
+            result["documents"].append([self.documents[i] for i, _ in top])
+            result["metadatas"].append([json.loads(self.metadatas[i]) if self.metadatas[i] else None for i, _ in top])
+            result["distances"].append([-score for _, score in top])
+        return result
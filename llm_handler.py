@@ -1,4 +1,7 @@
 import os
+import time
+import weakref
+import threading
 import yaml
 from dotenv import load_dotenv
 load_dotenv()
@@ -7,76 +10,413 @@ with open('config.yaml', 'r') as f:
     cfg = yaml.safe_load(f)
 
 
+class LLMClients():
+    """
+    One client per provider and process, shared by all LLMQuery calls and threads.
+    Creating a client opens a new connection pool, so every call would otherwise pay for
+    connection setup and TLS handshake; shared clients keep their connections alive.
+    The OpenAI and xAI clients are thread-safe; async clients are bound to an event loop
+    and are therefore kept per loop. Timeout and pool size are set by `timeout` and
+    `max_connections` in the llm section of config.yaml.
+    """
+    _clients = {}
+    # async clients per provider and event loop, dropped with their loop
+    _async_clients = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get(cls, provider, create):
+        client = cls._clients.get(provider)
+        if client is None:
+            with cls._lock:
+                client = cls._clients.get(provider)
+                if client is None:
+                    client = cls._clients[provider] = create()
+        return client
+
+    @classmethod
+    def _get_async(cls, provider, create):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            clients = cls._async_clients.setdefault(provider, weakref.WeakKeyDictionary())
+            client = clients.get(loop)
+            if client is None:
+                client = clients[loop] = create()
+        return client
+
+    @staticmethod
+    def _settings():
+        llm_cfg = cfg.get('llm', {})
+        return llm_cfg.get('timeout') or 3600, llm_cfg.get('max_connections') or 20
+
+    @classmethod
+    def openai(cls):
+        def create():
+            import httpx
+            from openai import OpenAI, DefaultHttpxClient
+
+            timeout, max_connections = cls._settings()
+            return OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=timeout,
+                # retries are done by RequestScheduler
+                max_retries=0,
+                http_client=DefaultHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)),
+            )
+        return cls._get("openAI", create)
+
+    @classmethod
+    def async_openai(cls):
+        def create():
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            timeout, max_connections = cls._settings()
+            return AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=timeout,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)),
+            )
+        return cls._get_async("openAI", create)
+
+    @classmethod
+    def xai(cls):
+        def create():
+            from xai_sdk import Client
+
+            timeout, _ = cls._settings()
+            return Client(api_key=os.getenv("XAI_API_KEY"), timeout=timeout)
+        return cls._get("xai", create)
+
+    @classmethod
+    def async_xai(cls):
+        def create():
+            from xai_sdk import AsyncClient
+
+            timeout, _ = cls._settings()
+            return AsyncClient(api_key=os.getenv("XAI_API_KEY"), timeout=timeout)
+        return cls._get_async("xai", create)
+
+
+class LLMLimits():
+    """
+    Concurrency limits of the async LLM calls: at most `max_concurrent_requests` requests
+    in flight overall and at most `provider_concurrency[provider]` per provider (llm section
+    of config.yaml). asyncio semaphores belong to an event loop, so they are kept per loop.
+    """
+    _semaphores = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+
+    @classmethod
+    def semaphores(cls, provider: str):
+        """(global semaphore, provider semaphore) of the running event loop."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        llm_cfg = cfg.get('llm', {})
+        global_limit = llm_cfg.get('max_concurrent_requests') or 16
+        with cls._lock:
+            semaphores = cls._semaphores.get(loop)
+            if semaphores is None:
+                semaphores = cls._semaphores[loop] = {None: asyncio.Semaphore(global_limit)}
+            if provider not in semaphores:
+                limit = (llm_cfg.get('provider_concurrency') or {}).get(provider)
+                semaphores[provider] = asyncio.Semaphore(limit or global_limit)
+            return semaphores[None], semaphores[provider]
+
+
 class LLMQuery():
-    def __init__(self, system_prompt: str, user_prompt: str):
+    # completions cache shared by all queries of the process, see response_cache in config.yaml
+    _response_cache = None
+    _response_cache_lock = threading.Lock()
+
+    def __init__(self, system_prompt: str, user_prompt: str, purpose: str = None):
         self.system_prompt = system_prompt
         self.user_prompt = user_prompt
+        # stage of the framework the query belongs to (e.g. sub_query, relevance, final), see CallTracker
+        self.purpose = purpose
 
-    def __open_ai(self, system_prompt=None, user_prompt=None):
-        from openai import OpenAI
+    @classmethod
+    def get_response_cache(cls):
+        """
+        LLMResponseCache for `response_cache: read_write` (look up, store new responses) or
+        `replay` (read-only, a prompt without cached response fails); None if it is off.
+        """
+        mode = cfg.get('llm', {}).get('response_cache') or "off"
+        if mode == "off":
+            return None
+        if mode not in ("read_write", "replay"):
+            raise ValueError(f"Unknown response_cache mode: {mode!r}. Must be 'off', 'read_write' or 'replay'.")
+        if cls._response_cache is None:
+            from llm_response_cache import LLMResponseCache
+            with cls._response_cache_lock:
+                if cls._response_cache is None:
+                    llm_cfg = cfg.get('llm', {})
+                    max_mb = llm_cfg.get('response_cache_max_mb')
+                    cls._response_cache = LLMResponseCache(
+                        llm_cfg.get('response_cache_path') or "llm_response_cache.sqlite3",
+                        max_bytes=max_mb * 1024 * 1024 if max_mb else None,
+                        read_only=mode == "replay",
+                    )
+        return cls._response_cache
 
-        client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+    @classmethod
+    def response_cache_stats(cls):
+        response_cache = cls.get_response_cache()
+        return response_cache.stats() if response_cache is not None else None
+
+    @staticmethod
+    def sampling_params(provider):
+        """Sampling parameters sent with every request of a provider; part of the response cache key."""
+        return {"temperature": 0} if provider == 'xai' else {}
+
+    def _cached_response(self, provider, system_prompt=None, user_prompt=None):
+        """Cached completion of the prompts, None if there is none (or the cache is off)."""
+        response_cache = self.get_response_cache()
+        if response_cache is None:
+            return None
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+        response = response_cache.get(provider, self._model(provider), system_prompt, user_prompt, self.sampling_params(provider))
+        if response is None and response_cache.read_only:
+            raise ValueError(f"No cached {provider} response for this prompt (response_cache: replay).")
+        return response
+
+    def _cache_response(self, provider, response, system_prompt=None, user_prompt=None):
+        response_cache = self.get_response_cache()
+        if response_cache is not None:
+            system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+            response_cache.put(provider, self._model(provider), system_prompt, user_prompt, response, self.sampling_params(provider))
+
+    def _prompts(self, system_prompt=None, user_prompt=None):
         # if no specific user_prompt and system_prompt provided, use the ones from test case
         if not system_prompt and not user_prompt:
-            response = client.chat.completions.create(
-                model=cfg.get('llm', {}).get('openAI_model'),
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": self.user_prompt
-                    }
-                ],
-            )
+            return self.system_prompt, self.user_prompt
         elif system_prompt and user_prompt:
+            return system_prompt, user_prompt
+        raise ValueError("Both system_prompt and user_prompt must be provided together.")
+
+    @staticmethod
+    def _messages(system_prompt, user_prompt):
+        return [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ]
+
+    @staticmethod
+    def stream_responses():
+        return bool(cfg.get('llm', {}).get('stream_responses'))
+
+    def __open_ai(self, system_prompt=None, user_prompt=None):
+        """Completion, token usage and time to first token (streamed responses only)."""
+        client = LLMClients.openai()
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+        if not self.stream_responses():
             response = client.chat.completions.create(
                 model=cfg.get('llm', {}).get('openAI_model'),
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
+                messages=self._messages(system_prompt, user_prompt),
             )
-        else:
-            raise ValueError("Both system_prompt and user_prompt must be provided together.")
-            
-        return response.choices[0].message.content
+            return response.choices[0].message.content, response.usage, None
+
+        start = time.perf_counter()
+        stream = client.chat.completions.create(
+            model=cfg.get('llm', {}).get('openAI_model'),
+            messages=self._messages(system_prompt, user_prompt),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts, usage, time_to_first_token = [], None, None
+        for chunk in stream:
+            # the last chunk carries the usage and no choices
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+        return "".join(parts), usage, time_to_first_token
     
-    def __xai(self):
-        from xai_sdk import Client
+    def __xai(self, system_prompt=None, user_prompt=None):
         from xai_sdk.chat import user, system
-        client = Client(
-            api_key=os.getenv("XAI_API_KEY"),
-            timeout=3600,  
-            )
+        client = LLMClients.xai()
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
 
         chat = client.chat.create(
             model=cfg.get('llm', {}).get('xai_model'), 
-            temperature=0
+            **self.sampling_params('xai')
             )
-        chat.append(system(self.system_prompt))
-        chat.append(user(self.user_prompt))
+        chat.append(system(system_prompt))
+        chat.append(user(user_prompt))
 
-        response = chat.sample()
-        return response.content
+        if not self.stream_responses():
+            response = chat.sample()
+            return response.content, response.usage, None
+
+        start = time.perf_counter()
+        response, time_to_first_token = None, None
+        # the stream yields the accumulated response with every chunk
+        for response, chunk in chat.stream():
+            if time_to_first_token is None and chunk.content:
+                time_to_first_token = time.perf_counter() - start
+        return response.content, response.usage, time_to_first_token
     
+    def _model(self, provider):
+        return cfg.get('llm', {}).get('openAI_model' if provider == 'openAI' else 'xai_model')
+
+    def estimated_tokens(self, provider, system_prompt=None, user_prompt=None):
+        """Tokens a request counts against the provider's token limit: prompt plus expected output."""
+        from token_handler import count_tokens, encoding_name_for_model
+
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+        encoding_name = encoding_name_for_model(self._model(provider))
+        expected_output_tokens = cfg.get('request_scheduling', {}).get('expected_output_tokens') or 0
+        return count_tokens(system_prompt, encoding_name) + count_tokens(user_prompt, encoding_name) + expected_output_tokens
+
+    def _record_call(self, provider, started, attempt):
+        """
+        Record the request with CallTracker. `attempt` holds latency, usage and time to first
+        token of the successful attempt; the rest of the time since `started` was spent waiting
+        for rate limits, concurrency slots and retries.
+        """
+        from call_tracker import CallTracker
+
+        CallTracker.record(
+            "llm", provider, self._model(provider), attempt["latency"],
+            usage=CallTracker.usage(attempt["usage"]),
+            time_to_first_token=attempt["time_to_first_token"],
+            wait_time=max(0.0, time.perf_counter() - started - attempt["latency"]),
+            purpose=self.purpose,
+        )
+
+    def _record_cache_hit(self, provider, started):
+        from call_tracker import CallTracker
+
+        CallTracker.record("llm", provider, self._model(provider), time.perf_counter() - started, purpose=self.purpose, response_cache=True)
+
     def process(self, user_prompt=None, system_prompt=None):
+        """
+        Send the prompts to the configured provider within its rate limits (see RequestScheduler),
+        or answer from the response cache if it is enabled. The call is recorded with CallTracker.
+        """
+        from request_scheduler import RequestScheduler
+
         provider = cfg.get('llm').get('provider')
         if provider == 'openAI': 
-            return self.__open_ai(user_prompt=user_prompt, system_prompt=system_prompt)
+            request = lambda: self.__open_ai(user_prompt=user_prompt, system_prompt=system_prompt)
         elif provider == 'xai':
-            return self.__xai()
+            request = lambda: self.__xai(user_prompt=user_prompt, system_prompt=system_prompt)
         else:
             raise ValueError(f"Unsupported llm provider: {provider!r}. Must be 'openAI' or 'xai'.")
+        started = time.perf_counter()
+        response = self._cached_response(provider, system_prompt, user_prompt)
+        if response is not None:
+            self._record_cache_hit(provider, started)
+            return response
+
+        attempt = {}
+
+        def send():
+            start = time.perf_counter()
+            content, usage, time_to_first_token = request()
+            attempt.update(latency=time.perf_counter() - start, usage=usage, time_to_first_token=time_to_first_token)
+            return content
+
+        n_tokens = self.estimated_tokens(provider, system_prompt, user_prompt) if RequestScheduler.limiter(provider, self._model(provider)).counts_tokens else 0
+        response = RequestScheduler.call(provider, self._model(provider), n_tokens, send)
+        self._record_call(provider, started, attempt)
+        self._cache_response(provider, response, system_prompt, user_prompt)
+        return response
+
+    async def __aopen_ai(self, system_prompt=None, user_prompt=None):
+        client = LLMClients.async_openai()
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+        if not self.stream_responses():
+            response = await client.chat.completions.create(
+                model=cfg.get('llm', {}).get('openAI_model'),
+                messages=self._messages(system_prompt, user_prompt),
+            )
+            return response.choices[0].message.content, response.usage, None
+
+        start = time.perf_counter()
+        stream = await client.chat.completions.create(
+            model=cfg.get('llm', {}).get('openAI_model'),
+            messages=self._messages(system_prompt, user_prompt),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts, usage, time_to_first_token = [], None, None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+        return "".join(parts), usage, time_to_first_token
+
+    async def __axai(self, system_prompt=None, user_prompt=None):
+        from xai_sdk.chat import user, system
+        client = LLMClients.async_xai()
+        system_prompt, user_prompt = self._prompts(system_prompt, user_prompt)
+
+        chat = client.chat.create(
+            model=cfg.get('llm', {}).get('xai_model'),
+            **self.sampling_params('xai')
+            )
+        chat.append(system(system_prompt))
+        chat.append(user(user_prompt))
+
+        if not self.stream_responses():
+            response = await chat.sample()
+            return response.content, response.usage, None
+
+        start = time.perf_counter()
+        response, time_to_first_token = None, None
+        async for response, chunk in chat.stream():
+            if time_to_first_token is None and chunk.content:
+                time_to_first_token = time.perf_counter() - start
+        return response.content, response.usage, time_to_first_token
+
+    async def aprocess(self, user_prompt=None, system_prompt=None):
+        """
+        Async counterpart of process() using the providers' async clients. Waits for the
+        rate limits (see RequestScheduler) and for a free slot of the global and the provider
+        limit (see LLMLimits) before sending the request; the slot is released during retry backoff.
+        """
+        from request_scheduler import RequestScheduler
+
+        provider = cfg.get('llm').get('provider')
+        if provider not in ('openAI', 'xai'):
+            raise ValueError(f"Unsupported llm provider: {provider!r}. Must be 'openAI' or 'xai'.")
+        started = time.perf_counter()
+        response = self._cached_response(provider, system_prompt, user_prompt)
+        if response is not None:
+            self._record_cache_hit(provider, started)
+            return response
+        global_limit, provider_limit = LLMLimits.semaphores(provider)
+        attempt = {}
+
+        async def send():
+            async with global_limit, provider_limit:
+                start = time.perf_counter()
+                if provider == 'openAI':
+                    content, usage, time_to_first_token = await self.__aopen_ai(user_prompt=user_prompt, system_prompt=system_prompt)
+                else:
+                    content, usage, time_to_first_token = await self.__axai(user_prompt=user_prompt, system_prompt=system_prompt)
+                attempt.update(latency=time.perf_counter() - start, usage=usage, time_to_first_token=time_to_first_token)
+                return content
+
+        n_tokens = self.estimated_tokens(provider, system_prompt, user_prompt) if RequestScheduler.limiter(provider, self._model(provider)).counts_tokens else 0
+        response = await RequestScheduler.acall(provider, self._model(provider), n_tokens, send)
+        self._record_call(provider, started, attempt)
+        self._cache_response(provider, response, system_prompt, user_prompt)
+        return response
         
- 
\ No newline at end of file
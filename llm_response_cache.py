@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class LLMResponseCache():
+    """
+    Persistent cache for LLM completions, so that re-running the test cases (e.g. after a
+    change to the evaluation) does not pay for the same completions again.
+
+    Entries are keyed by (provider, model, system prompt hash, user prompt hash, sampling
+    parameters) and hold the completion text exactly as returned. The least recently used
+    entries are evicted once the stored responses exceed `max_bytes`. In read-only mode
+    (replay) the file is opened read-only and nothing is written, not even the last use.
+    """
+    def __init__(self, path: str, max_bytes=None, read_only: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if read_only:
+            if not os.path.exists(path):
+                raise ValueError(f"LLM response cache {path} does not exist, it cannot be replayed.")
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            return
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                system_prompt_hash TEXT NOT NULL,
+                user_prompt_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+
+    def __repr__(self):
+        return f"{__class__.__name__}('{self.path}'{', read-only' if self.read_only else ''})"
+
+    @staticmethod
+    def key(provider: str, model: str, system_prompt: str, user_prompt: str, params=None):
+        """Cache key and its parts (prompt hashes, canonical sampling parameters)."""
+        system_prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        user_prompt_hash = hashlib.sha256(user_prompt.encode("utf-8")).hexdigest()
+        params = json.dumps(params or {}, sort_keys=True)
+        key = hashlib.sha256("\n".join([provider, model, system_prompt_hash, user_prompt_hash, params]).encode("utf-8")).hexdigest()
+        return key, system_prompt_hash, user_prompt_hash, params
+
+    def get(self, provider: str, model: str, system_prompt: str, user_prompt: str, params=None):
+        """Cached response, None on a miss."""
+        key = self.key(provider, model, system_prompt, user_prompt, params)[0]
+        with self._lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", [key]).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", [time.time(), key])
+                self.connection.commit()
+            return row[0]
+
+    def put(self, provider: str, model: str, system_prompt: str, user_prompt: str, response: str, params=None):
+        if self.read_only or response is None:
+            return
+        key, system_prompt_hash, user_prompt_hash, params = self.key(provider, model, system_prompt, user_prompt, params)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, model, system_prompt_hash, user_prompt_hash, params, response, size, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [key, provider, model, system_prompt_hash, user_prompt_hash, params, response, len(response.encode("utf-8")), time.time()]
+            )
+            if self.max_bytes:
+                # drop the least recently used responses beyond max_bytes
+                self.connection.execute(
+                    """DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total_size FROM responses
+                        ) WHERE total_size > ?
+                    )""",
+                    [self.max_bytes]
+                )
+            self.connection.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "size": size,
+            }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
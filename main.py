@@ -2,29 +2,91 @@
 
 ## Create System documentation embedding
 if False:
+    import yaml
     from chroma_handler import ChromaDB
+    from ingestion_manifest import IngestionManifest
+    from ingestion_pipeline import IngestionPipeline
     from system_documentation import APIDocumentation, DBDocumentation, BusinessObjectDescription
 
-    APIDocumentation.instanciate_from_json_list()
-    DBDocumentation.instanciate_from_list()
-    BusinessObjectDescription.instanciate_from_list()
+    with open('config.yaml', 'r') as f:
+        cfg = yaml.safe_load(f)
 
-    for documentation in APIDocumentation.all:
-        print(f"Processing file: {documentation.file_name}")
-        documentation.create_swagger_chunks()
-        for chunk in documentation.get_chunks():
-            chroma_client = ChromaDB()
-            chroma_client.add_embedding_to_db(str(chunk), documentation.get_file_name(), documentation.get_business_object_name(), "API")
+    # only (re-)index files that are new or changed since the last ingestion
+    manifest = IngestionManifest.load(ChromaDB.chroma_persist_dir, ChromaDB.ingestion_settings())
+    changed_files, removed_files = manifest.detect_changes(cfg.get('system_documentation', {}).get('source_folder'))
+    print(f"{len(changed_files)} new or changed files, {len(removed_files)} removed files")
+
+    DBDocumentation.instanciate_from_list(changed_files)
+    BusinessObjectDescription.instanciate_from_list(changed_files)
 
+    # DB and TXT descriptions are small and embedded as they are
+    documents = []
     for documentation in DBDocumentation.all:
         print(f"Processing file: {documentation.file_name}")
-        chroma_client = ChromaDB()
-        chroma_client.add_embedding_to_db(documentation.get_db_description(), documentation.get_file_name(), documentation.get_business_object_name(), "DB")
+        documents.append({
+            "text": documentation.get_db_description(),
+            "file_name": documentation.get_file_name(),
+            "file_path": documentation.get_file_path(),
+            "business_object": documentation.get_business_object_name(),
+            "source_type": "DB",
+        })
 
     for documentation in BusinessObjectDescription.all:
         print(f"Processing file: {documentation.file_name}")
-        chroma_client = ChromaDB()
-        chroma_client.add_embedding_to_db(documentation.get_business_object_description(), documentation.get_file_name(), documentation.get_business_object_name(), "TXT")
+        documents.append({
+            "text": documentation.get_business_object_description(),
+            "file_name": documentation.get_file_name(),
+            "file_path": documentation.get_file_path(),
+            "business_object": documentation.get_business_object_name(),
+            "source_type": "TXT",
+        })
+
+    # swagger specs are loaded and chunked in worker processes, chunks are embedded by a thread pool
+    api_files = APIDocumentation.find_api_json_files(changed_files)
+    chroma_client = ChromaDB()
+    pipeline = IngestionPipeline(chroma_client)
+    print(f"Indexing {len(api_files)} API specs and {len(documents)} documents with {pipeline}...")
+    # files that could not be loaded are left out and stay "changed" for the next run
+    chunk_ids_by_file = pipeline.run(api_files, documents)
+
+    # drop chunks of changed and removed files that are not part of the index anymore
+    stale_ids = manifest.update(chunk_ids_by_file, removed_files)
+    chroma_client.delete_embeddings(stale_ids)
+    manifest.save()
+
+## convert the JSON sidecars of existing indexes (chroma_db_*) to the columnar format
+if False:
+    import os
+    import glob
+    from columnar_store import ColumnarStore
+
+    for persist_dir in sorted(glob.glob("chroma_db_*")):
+        if os.path.isdir(persist_dir):
+            ColumnarStore.migrate(persist_dir, remove_json=False)
+
+## compare reduced embedding storage (dimensions, float16/int8) against the full-precision index
+if False:
+    from chroma_handler import ChromaDB
+    from embedding_storage import EmbeddingStorage
+
+    chroma_client = ChromaDB()
+    for collection in chroma_client.get_client().list_collections():
+        embeddings = collection.get(include=["embeddings"])["embeddings"]
+        if embeddings is None or len(embeddings) < 2:
+            continue
+        print(f"{collection.name} ({len(embeddings)} embeddings):")
+        for row in EmbeddingStorage.recall_report(embeddings, dimensions=[256, 512, 1024]):
+            print(f"    {row}")
+
+## check the business object routing against the test case prompts (route_business_objects)
+if False:
+    from retrieval_router import BusinessObjectRouter
+
+    report = BusinessObjectRouter.from_documentation().routing_report("test_cases")
+    print(f"{report['prompts']} prompts: {report['hit']} routed to their business object, {report['missed']} missed, {report['unrouted']} unrouted, {report['routed objects']} business objects per routed prompt")
+    # missed prompts are only ranked lower, retrieve_many still searches all business objects
+    for business_object, routed, prompt in report['missed prompts']:
+        print(f"    {business_object} -> {routed}: {prompt[:100]}")
 
 ## run and evaluate tests
 if True:
@@ -33,6 +95,8 @@ if True:
     from support_functions import SupportFunctions
     from testcase import APITestcase, SQLTestcase, Testcase
     from evaluation import Evaluation
+    from llm_handler import LLMQuery
+    from call_tracker import CallTracker
 
 
     APITestcase.instantiate_from_raw_test_case()
@@ -47,14 +111,57 @@ if True:
     with open('config.yaml', 'r') as f:
         cfg = yaml.safe_load(f)
 
-    if cfg.get('process_orchestration').get('rag_framework') == "RAG":
+    # retrieve the documentation for all user prompts in a few batched calls before generation starts
+    if cfg.get('embedding', {}).get('prefetch_retrieval') and cfg.get('process_orchestration').get('knowledge_basis').upper() != "NONE":
+        from chroma_handler import ChromaDB
+        n_prefetched = ChromaDB().prefetch([test_case.get_user_prompt() for test_case in Testcase.all])
+        print(f"Prefetched documentation for {n_prefetched} user prompts")
+
+    # all test cases at once with the async LLM interface, the number of requests in flight is bounded by the llm limits
+    concurrent_test_cases = cfg.get('process_orchestration').get('concurrent_test_cases')
+    if concurrent_test_cases:
+        import asyncio
+
+        rag_framework = cfg.get('process_orchestration').get('rag_framework')
+        if rag_framework == "RAG":
+            from rag_framework_rag import RAGProcess as Process
+            run_name = "RAG run"
+        elif rag_framework == "SelfRAG":
+            from rag_framework_selfrag import SelfRAGProcess as Process
+            run_name = "Self-RAG run"
+        elif rag_framework == "CoRAG":
+            from rag_framework_corag import CoRAGProcess as Process
+            run_name = "CoRAG run"
+        else:
+            raise ValueError(f"Unsupported rag framework: {rag_framework!r}")
+
+        async def run_test_case(i, test_case):
+            try:
+                with CallTracker.track(test_case):
+                    await Process(test_case).agenerate_response()
+                print(f"Processed test case {i}/{len(Testcase.all)}")
+            except Exception as e:
+                print(f"[ERROR] Test case {i} failed during {run_name}: {e}")
+                try:
+                    setattr(test_case, "error", f"{run_name} failed: {e}")
+                    test_case.save_to_json(error_folder, i)
+                except Exception as inner_e:
+                    print(f"[ERROR] Failed to save error JSON for test case {i}: {inner_e}")
+
+        async def run_all_test_cases():
+            await asyncio.gather(*(run_test_case(i, test_case) for i, test_case in enumerate(Testcase.all, start=1)))
+
+        asyncio.run(run_all_test_cases())
+
+    if cfg.get('process_orchestration').get('rag_framework') == "RAG" and not concurrent_test_cases:
         from rag_framework_rag import RAGProcess
 
         for test_case in Testcase.all:
             try:
                 print(f"Processing test case {i}/{len(Testcase.all)}")
                 test_run = RAGProcess(test_case)
-                test_run.generate_response() 
+                with CallTracker.track(test_case):
+                    test_run.generate_response()
             except Exception as e:
                 print(f"[ERROR] Test case {i} failed during RAG run: {e}")
                 try:
@@ -65,13 +172,14 @@ if True:
             finally:
                 i += 1
 
-    if cfg.get('process_orchestration').get('rag_framework') == "SelfRAG":
+    if cfg.get('process_orchestration').get('rag_framework') == "SelfRAG" and not concurrent_test_cases:
         from rag_framework_selfrag import SelfRAGProcess
         for test_case in Testcase.all:
             try:
                 print(f"Processing test case {i}/{len(Testcase.all)}")
                 test_run = SelfRAGProcess(test_case)
-                test_run.generate_response()
+                with CallTracker.track(test_case):
+                    test_run.generate_response()
             except Exception as e:
                 print(f"[ERROR] Test case {i} failed during Self-RAG run: {e}")
                 try:
@@ -84,13 +192,14 @@ if True:
         
 
 
-    if cfg.get('process_orchestration').get('rag_framework') == "CoRAG":
+    if cfg.get('process_orchestration').get('rag_framework') == "CoRAG" and not concurrent_test_cases:
         from rag_framework_corag import CoRAGProcess
         for test_case in Testcase.all:
             try:
                 print(f"Processing test case {i}/{len(Testcase.all)}")
                 test_run = CoRAGProcess(test_case)
-                test_run.generate_response()
+                with CallTracker.track(test_case):
+                    test_run.generate_response()
             except Exception as e:
                 print(f"[ERROR] Test case {i} failed during CoRAG run: {e}")
                 try:
@@ -101,6 +210,15 @@ if True:
             finally:
                 i += 1
 
+    if cfg.get('process_orchestration').get('knowledge_basis').upper() != "NONE":
+        from chroma_handler import ChromaDB
+        query_cache_stats = ChromaDB.query_cache_stats()
+        print(f"Query embedding cache: {query_cache_stats['hits']} hits, {query_cache_stats['misses']} misses ({query_cache_stats['hit_rate']:.1%} hit rate, {query_cache_stats['entries']} entries)")
+
+    response_cache_stats = LLMQuery.response_cache_stats()
+    if response_cache_stats is not None:
+        print(f"LLM response cache: {response_cache_stats['hits']} hits, {response_cache_stats['misses']} misses ({response_cache_stats['hit_rate']:.1%} hit rate, {response_cache_stats['entries']} entries, {response_cache_stats['size'] / 1024 / 1024:.1f} MB)")
+
     # evaluate results
     print("Evaluating api test cases...")
     for api_test_case in APITestcase.all:
@@ -1,4 +1,5 @@
 
+import asyncio
 from chroma_handler import ChromaDB
 from llm_handler import LLMQuery
 
@@ -33,90 +34,132 @@ Output: Return only a single, complete, correct, and executable REST API call. D
 -----
 CONTEXT:"""
 
-    def get_system_documentation(self):
-        chroma = ChromaDB()
-        original_query = self.test_case.get_user_prompt()
-        sub_answers = []
-        max_steps = 5 
-        for step in range(max_steps):
-            # Prepare system and user prompts for sub-query generation
-            if step == 0:
-                sub_query_system = ("""Role: You are an expert assistant for breaking down complex queries into simpler sub-queries for step-by-step retrieval. The main goal is to provide the step-by-step information to complete the 'Final task'. 
+    def _sub_query_prompts(self, step, original_query, sub_answers):
+        # Prepare system and user prompts for sub-query generation
+        if step == 0:
+            sub_query_system = ("""Role: You are an expert assistant for breaking down complex queries into simpler sub-queries for step-by-step retrieval. The main goal is to provide the step-by-step information to complete the 'Final task'. 
 Output: 
 - Analyze the user's query and provide the first sub-query needed to find information that will help answer the overall question.
 - If no sub-query is needed (i.e., the question can be answered directly), respond with 'FINAL' and do not create any additional text.""")
 
-                sub_query_user = f"User Query: {original_query}"        
-            else:
-                known_info_str = "\n".join([f"Sub-answer {i+1}: {ans}" for i, ans in enumerate(sub_answers)])
-                sub_query_system = ("""Role: You are an support assistant required for breaking down complex queries into simpler sub-queries for step-by-step retrieval. The main goal is to provide the step-by-step information to complete the 'Final task'. From previous steps there is already 'known information' gathered, and we still need to answer the 'Original question'.
+            sub_query_user = f"User Query: {original_query}"        
+        else:
+            known_info_str = "\n".join([f"Sub-answer {i+1}: {ans}" for i, ans in enumerate(sub_answers)])
+            sub_query_system = ("""Role: You are an support assistant required for breaking down complex queries into simpler sub-queries for step-by-step retrieval. The main goal is to provide the step-by-step information to complete the 'Final task'. From previous steps there is already 'known information' gathered, and we still need to answer the 'Original question'.
 
 Output: 
 - Based on the original question and the information gathered so far, provide the next sub-query to find the remaining information.
 - If no sub-query is needed (i.e., the question can be answered directly), respond with 'FINAL' and do not create any additional text.""")
 
-                sub_query_user = (
-                    f"Original Question:\n{original_query}\n"
-                    f"Known Information:\n{known_info_str}\n"
-                )
+            sub_query_user = (
+                f"Original Question:\n{original_query}\n"
+                f"Known Information:\n{known_info_str}\n"
+            )
+
+        task = "\n".join(["User request: ", sub_query_user, "Final task: ", self.system_prompt])
+        return sub_query_system, task
+
+    def _sub_answer_prompts(self, sub_query_text, retrieved_docs):
+        docs_content = "\n".join([doc['document'] for doc in retrieved_docs])
+        sub_answer_system = (
+            """You are an expert assistant tasked with extracting the specific answer to a question from provided documentation.
+Using only the following documents, provide a concise answer to the sub-query."""
+        )
+        sub_answer_user = f"Sub-query: {sub_query_text}\nDocuments:\n{docs_content}"
+        return sub_answer_system, sub_answer_user
+
+    def _next_retrieval(self, step, original_query, sub_query):
+        """
+        Book a generated sub-query in the history and decide the next step of the chain.
+        Returns the text to retrieve documentation for (None to end the chain right away)
+        and whether the chain ends after that retrieval.
+        """
+        self.test_case.add_corag_history(f"Generated sub-query at step {step+1}:{sub_query}")
+        #print(f"\n*****\nGenerated sub-query at step {step+1}:\n{sub_query}\n*****")
+        if sub_query is None:
+            # No response from LLM (edge case)
+            return None, True
+        sub_query_text = sub_query.strip()
+
+        # Check if no further sub-query is needed
+        if sub_query_text.upper().startswith("FINAL"):
+            # If even the first step says FINAL, do a direct retrieval on the original query
+            return (original_query if step == 0 else None), True
+        return sub_query_text, False
+
+    def _add_retrieved_docs(self, retrieved_docs):
+        # Store retrieved docs from this step
+        for doc in retrieved_docs:
+            self.test_case.add_retrieved_documentation(doc['document'])
 
-            task = "\n".join(["User request: ", sub_query_user, "Final task: ", self.system_prompt])
+    def _add_sub_answer(self, sub_answer, sub_answers):
+        """Store a sub-answer; returns False if the LLM failed to produce one, which stops the chain."""
+        if not sub_answer:
+            return False
+        # store the sub-answer in corag documentation
+        self.test_case.add_corag_history(sub_answer)
+        # Add the sub-answer to our context and continue to next iteration
+        sub_answers.append(str(sub_answer).strip())
+        return True
+
+    def get_system_documentation(self):
+        chroma = ChromaDB()
+        original_query = self.test_case.get_user_prompt()
+        sub_answers = []
+        max_steps = 5 
+        for step in range(max_steps):
+            sub_query_system, task = self._sub_query_prompts(step, original_query, sub_answers)
             # Generate sub-query or final decision using LLM
-            query_agent = LLMQuery(sub_query_system, task)
-            sub_query = query_agent.process()
-            self.test_case.add_corag_history(f"Generated sub-query at step {step+1}:{sub_query}")
-            #print(f"\n*****\nGenerated sub-query at step {step+1}:\n{sub_query}\n*****")
-            if sub_query is None:
-                # No response from LLM (edge case)
+            sub_query = LLMQuery(sub_query_system, task, purpose="sub_query").process()
+            retrieval_query, final = self._next_retrieval(step, original_query, sub_query)
+            if retrieval_query is None:
                 break
-            sub_query_text = sub_query.strip()
-            
-            # Check if no further sub-query is needed
-            if sub_query_text.upper().startswith("FINAL"):
-                if step == 0:
-                    # If even the first step says FINAL, do a direct retrieval on the original query
-                    retrieved_docs = chroma.retrieve(original_query)
-                    for doc in retrieved_docs:
-                        self.test_case.add_retrieved_documentation(doc['document'])
-                break  # end the chain
-            
-            
+
             # Retrieve documents for the generated sub-query
-            retrieved_docs = chroma.retrieve(sub_query_text)
-            if not retrieved_docs:
-                # If no docs found for this sub-query, stop the chain
+            retrieved_docs = chroma.retrieve(retrieval_query)
+            self._add_retrieved_docs(retrieved_docs)
+            if final or not retrieved_docs:
+                # end the chain, also if no docs were found for this sub-query
                 break
-            # Store retrieved docs from this step
-            for doc in retrieved_docs:
-                self.test_case.add_retrieved_documentation(doc['document'])
-            
+
             # Use LLM to extract a concise sub-answer from the retrieved docs
-            docs_content = "\n".join([doc['document'] for doc in retrieved_docs])
-            sub_answer_system = (
-                """You are an expert assistant tasked with extracting the specific answer to a question from provided documentation.
-Using only the following documents, provide a concise answer to the sub-query."""
-            )
-            sub_answer_user = f"Sub-query: {sub_query_text}\nDocuments:\n{docs_content}"
-            answer_agent = LLMQuery(sub_answer_system, sub_answer_user)
-            sub_answer = answer_agent.process()
+            sub_answer_system, sub_answer_user = self._sub_answer_prompts(retrieval_query, retrieved_docs)
+            sub_answer = LLMQuery(sub_answer_system, sub_answer_user, purpose="sub_answer").process()
             #print(f"\n*****\nExtracted sub-answer at step {step+1}:\n{sub_answer}\n*****")
-            if not sub_answer:
-                # If LLM failed to produce an answer, stop the chain
+            if not self._add_sub_answer(sub_answer, sub_answers):
+                break
+
+        self.test_case.add_corag_number_of_iterations(step + 1) # type: ignore
+
+    async def aget_system_documentation(self):
+        """
+        Async counterpart of get_system_documentation. The steps of a chain depend on each
+        other and stay sequential; concurrency comes from running many test cases at once.
+        """
+        chroma = ChromaDB()
+        original_query = self.test_case.get_user_prompt()
+        sub_answers = []
+        max_steps = 5 
+        for step in range(max_steps):
+            sub_query_system, task = self._sub_query_prompts(step, original_query, sub_answers)
+            sub_query = await LLMQuery(sub_query_system, task, purpose="sub_query").aprocess()
+            retrieval_query, final = self._next_retrieval(step, original_query, sub_query)
+            if retrieval_query is None:
                 break
-            sub_answer_text = str(sub_answer).strip()
 
-            # store the sub-answer in corag documentation
-            self.test_case.add_corag_history(sub_answer)
-            
+            retrieved_docs = await asyncio.to_thread(chroma.retrieve, retrieval_query)
+            self._add_retrieved_docs(retrieved_docs)
+            if final or not retrieved_docs:
+                break
 
-            # Add the sub-answer to our context and continue to next iteration
-            sub_answers.append(sub_answer_text)
+            sub_answer_system, sub_answer_user = self._sub_answer_prompts(retrieval_query, retrieved_docs)
+            sub_answer = await LLMQuery(sub_answer_system, sub_answer_user, purpose="sub_answer").aprocess()
+            if not self._add_sub_answer(sub_answer, sub_answers):
+                break
 
         self.test_case.add_corag_number_of_iterations(step + 1) # type: ignore
 
-    def generate_response(self):
-        # Perform the chain-of-retrieval process to gather documentation
-        self.get_system_documentation()
+    def _build_final_system_prompt(self):
         docs = self.test_case.get_retrieved_documentation()
         # Build the final system prompt with all retrieved context (if any)
         if not docs:
@@ -124,6 +167,18 @@ Using only the following documents, provide a concise answer to the sub-query.""
         else:
             documentation_string = "\n" + " - \n".join([item for item in docs])
         self.test_case.add_final_system_prompt(self.system_prompt + documentation_string)
+
+    async def agenerate_response(self):
+        """Async counterpart of generate_response, so many test cases can run concurrently."""
+        await self.aget_system_documentation()
+        self._build_final_system_prompt()
+        final_query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
+        self.test_case.add_test_output(await final_query.aprocess())
+
+    def generate_response(self):
+        # Perform the chain-of-retrieval process to gather documentation
+        self.get_system_documentation()
+        self._build_final_system_prompt()
         # Query the LLM with the full context and original user query to get the final answer
-        final_query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt())
+        final_query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
         self.test_case.add_test_output(final_query.process())
@@ -1,3 +1,4 @@
+import asyncio
 from chroma_handler import ChromaDB
 from llm_handler import LLMQuery
 
@@ -42,9 +43,7 @@ CONTEXT:"""
                 self.test_case.add_retrieved_documentation(documentation['document'])
         
     
-    def generate_response(self):
-        self.get_system_documentation()
-
+    def _build_final_system_prompt(self):
         docs = self.test_case.get_retrieved_documentation()
 
         if not docs:
@@ -55,7 +54,19 @@ CONTEXT:"""
                 " - \n".join([item for item in self.test_case.get_retrieved_documentation()])
             )
         self.test_case.add_final_system_prompt(self.system_prompt + documentation_string)
-        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt())
+
+    async def agenerate_response(self):
+        """Async counterpart of generate_response, so many test cases can run concurrently."""
+        # retrieval is synchronous (Chroma, embedding API), it runs in a worker thread
+        await asyncio.to_thread(self.get_system_documentation)
+        self._build_final_system_prompt()
+        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
+        self.test_case.add_test_output(await query.aprocess())
+
+    def generate_response(self):
+        self.get_system_documentation()
+        self._build_final_system_prompt()
+        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
         self.test_case.add_test_output(query.process())
 
         #raise ValueError ("You are here 5")
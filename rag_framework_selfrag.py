@@ -1,3 +1,4 @@
+import asyncio
 from chroma_handler import ChromaDB
 from llm_handler import LLMQuery
 import json
@@ -47,12 +48,21 @@ CONTEXT:"""
         for documentation in relevant_documentation:
             self.test_case.add_relevant_documentation(documentation['document'])
 
+    async def aget_system_documentation(self):
+        """Async counterpart of get_system_documentation; all retrieved chunks are graded concurrently."""
+        chroma = ChromaDB()
+        retrieved_documentation = await asyncio.to_thread(chroma.retrieve, self.test_case.get_user_prompt())
+        for documentation in retrieved_documentation:
+            self.test_case.add_retrieved_documentation(documentation['document'])
+        relevances = await asyncio.gather(*(
+            chroma.aevaluate_relevance([entry['document']], self.test_case.get_user_prompt(), self.system_prompt)
+            for entry in retrieved_documentation
+        ))
+        for entry, relevance in zip(retrieved_documentation, relevances):
+            if relevance == 'true' or relevance == '{"relevance": true}':
+                self.test_case.add_relevant_documentation(entry['document'])
 
-        
-    
-    def generate_response(self):
-        self.get_system_documentation()
-
+    def _build_final_system_prompt(self):
         docs = self.test_case.get_retrieved_documentation()
 
         if not docs:
@@ -63,6 +73,17 @@ CONTEXT:"""
                 " - \n".join([item for item in self.test_case.get_relevant_documentation()])
             )
         self.test_case.add_final_system_prompt(self.system_prompt + documentation_string)
-        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt())
+
+    async def agenerate_response(self):
+        """Async counterpart of generate_response, so many test cases can run concurrently."""
+        await self.aget_system_documentation()
+        self._build_final_system_prompt()
+        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
+        self.test_case.add_test_output(await query.aprocess())
+
+    def generate_response(self):
+        self.get_system_documentation()
+        self._build_final_system_prompt()
+        query = LLMQuery(self.test_case.get_final_system_prompt(), self.test_case.get_user_prompt(), purpose="final")
         self.test_case.add_test_output(query.process())
 
@@ -0,0 +1,196 @@
+import time
+import random
+import threading
+import email.utils
+import yaml
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+
+class TokenBucket():
+    """
+    Budget of `per_minute` units (requests or tokens) that refills continuously and holds
+    at most one minute's worth. reserve() books the units right away and returns how long
+    the caller has to wait until they are covered, so concurrent callers queue up in order
+    instead of polling.
+    """
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{__class__.__name__}({self.per_minute}/min)"
+
+    def reserve(self, amount: float):
+        with self._lock:
+            now = time.monotonic()
+            self.available = min(self.per_minute, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            # a single request larger than the whole budget only has to wait for a full bucket
+            self.available -= min(amount, self.per_minute)
+            return 0.0 if self.available >= 0 else -self.available / self.rate
+
+
+class RateLimiter():
+    """
+    Request and token budget of one provider model, as set in the rate_limits of the
+    request_scheduling section of config.yaml. After a 429 the whole model is paused for
+    the backoff, so concurrent callers do not run into the same limit.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def counts_tokens(self):
+        """False if the model has no token limit, so callers can skip estimating the tokens."""
+        return self.tokens is not None
+
+    def wait_time(self, n_tokens: int):
+        """Book one request with n_tokens and return the seconds to wait before sending it."""
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(n_tokens))
+        return wait
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler():
+    """
+    Sends LLM and embedding requests within the rate limits of their provider and model
+    and retries rate limit (429), server (5xx), timeout and connection errors with jittered
+    exponential backoff, honouring Retry-After. The token cost of a request is estimated
+    by the caller with tiktoken (see token_handler). call() is used by the synchronous
+    paths, acall() by the async ones; both share the same budgets.
+    """
+    _limiters = {}
+    _lock = threading.Lock()
+
+    # gRPC status codes (xAI) that are worth a retry
+    _retryable_grpc_codes = ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL", "ABORTED")
+
+    @classmethod
+    def limiter(cls, provider: str, model: str):
+        key = (provider, model)
+        limiter = cls._limiters.get(key)
+        if limiter is None:
+            with cls._lock:
+                limiter = cls._limiters.get(key)
+                if limiter is None:
+                    limits = (cfg.get('request_scheduling', {}).get('rate_limits') or {}).get(model) or {}
+                    limiter = cls._limiters[key] = RateLimiter(limits.get('requests_per_minute'), limits.get('tokens_per_minute'))
+        return limiter
+
+    @staticmethod
+    def _status_code(error):
+        status_code = getattr(error, "status_code", None)
+        if status_code is None and callable(getattr(error, "code", None)):
+            try:
+                return error.code().name
+            except Exception:
+                return None
+        return status_code
+
+    @classmethod
+    def is_retryable(cls, error):
+        status_code = cls._status_code(error)
+        if isinstance(status_code, int):
+            return status_code in (408, 409, 429) or status_code >= 500
+        if isinstance(status_code, str):
+            return status_code in cls._retryable_grpc_codes
+        # connection errors and timeouts of the OpenAI client carry no status code
+        return any(error_type.__name__ in ("APIConnectionError", "APITimeoutError") for error_type in type(error).__mro__)
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds from the Retry-After (or retry-after-ms) header of an error response, None if absent."""
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        if headers.get("retry-after-ms"):
+            try:
+                return float(headers["retry-after-ms"]) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    @classmethod
+    def backoff(cls, attempt: int, error):
+        """Full-jitter exponential backoff, at least as long as the server's Retry-After."""
+        scheduling_cfg = cfg.get('request_scheduling', {})
+        base_delay = scheduling_cfg.get('retry_base_delay') or 1.0
+        max_delay = scheduling_cfg.get('retry_max_delay') or 60.0
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        retry_after = cls.retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def max_retries():
+        max_retries = cfg.get('request_scheduling', {}).get('max_retries')
+        return 6 if max_retries is None else max_retries
+
+    @classmethod
+    def _failed(cls, limiter, attempt, error, provider, model):
+        """Backoff before the next attempt; re-raises the error if it is not retried."""
+        if attempt >= cls.max_retries() or not cls.is_retryable(error):
+            raise error
+        delay = cls.backoff(attempt, error)
+        if cls._status_code(error) in (429, "RESOURCE_EXHAUSTED"):
+            limiter.pause(delay)
+        print(f"[WARN] {provider} {model} request failed ({error.__class__.__name__}: {cls._status_code(error)}), retry {attempt + 1}/{cls.max_retries()} in {delay:.1f}s")
+        return delay
+
+    @classmethod
+    def call(cls, provider: str, model: str, n_tokens: int, send):
+        """Run send() once the budget allows it, retrying transient errors."""
+        limiter = cls.limiter(provider, model)
+        attempt = 0
+        while True:
+            wait = limiter.wait_time(n_tokens)
+            if wait:
+                time.sleep(wait)
+            try:
+                return send()
+            except Exception as e:
+                time.sleep(cls._failed(limiter, attempt, e, provider, model))
+                attempt += 1
+
+    @classmethod
+    async def acall(cls, provider: str, model: str, n_tokens: int, send):
+        """Async counterpart of call(); send is a coroutine function."""
+        import asyncio
+
+        limiter = cls.limiter(provider, model)
+        attempt = 0
+        while True:
+            wait = limiter.wait_time(n_tokens)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await send()
+            except Exception as e:
+                await asyncio.sleep(cls._failed(limiter, attempt, e, provider, model))
+                attempt += 1
@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import threading
+
+
+class MetadataFilter():
+    """
+    Evaluation of Chroma `where` clauses on chunk metadata, for the local backends.
+    Supports field equality ({"field": value} or {"field": {"$eq": value}}), $ne, $in,
+    $nin and the logical operators $and and $or, which covers the filters built by retrieve.
+    """
+    @classmethod
+    def matches(cls, metadata, where):
+        if not where:
+            return True
+        metadata = metadata or {}
+        for key, condition in where.items():
+            if key == "$and":
+                if not all(cls.matches(metadata, clause) for clause in condition):
+                    return False
+            elif key == "$or":
+                if not any(cls.matches(metadata, clause) for clause in condition):
+                    return False
+            elif not cls._matches_condition(metadata.get(key), condition):
+                return False
+        return True
+
+    @staticmethod
+    def _matches_condition(value, condition):
+        if not isinstance(condition, dict):
+            return value == condition
+        for operator, operand in condition.items():
+            if operator == "$eq" and value != operand:
+                return False
+            elif operator == "$ne" and value == operand:
+                return False
+            elif operator == "$in" and value not in operand:
+                return False
+            elif operator == "$nin" and value in operand:
+                return False
+            elif operator not in ("$eq", "$ne", "$in", "$nin"):
+                raise ValueError(f"Unsupported filter operator: {operator}")
+        return True
+
+    @staticmethod
+    def key(where):
+        """Hashable representation of a filter, e.g. to cache partitions per filter."""
+        return json.dumps(where, sort_keys=True) if where else None
+
+
+class BusinessObjectRouter():
+    """
+    Cheap keyword router that predicts the business objects a query is about.
+
+    Every business object is known by the words of its name (the NAME_TO_URL keys, e.g.
+    bank_account_entry) and the service name at the end of its URL (bankaccountentry).
+    Words are compared in singular form on both sides, so "bank account entries" matches
+    bank_account_entry. A query mentions a business object if it contains all words of its
+    name, in any order, or its service name as identifier. A mentioned object whose words are
+    all part of another mentioned object's name is dropped in favour of the more specific one
+    ("lock request for a bank card contract" -> bank_card_contract_lock_request), and every
+    routed object brings along the objects that extend its name (bank_card_contract ->
+    bank_card_contract_lock_request), since a query rarely names the request it is about.
+    Table names of the DB descriptions are not used: the contract tables are shared by many
+    business objects and routed most loan and account queries to the wrong ones.
+
+    The routed objects are a ranking hint, not a hard filter: retrieve_many ranks their chunks
+    higher but keeps searching all chunks, because related business objects (e.g. the
+    bank_account_contract_* requests for a savings account contract) are easily missed.
+    """
+    _shared = None
+    _lock = threading.Lock()
+    _camel_case_pattern = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+    def __init__(self, names: dict, services: dict = None):
+        # business object -> frozenset of its (singular) name words
+        self.names = names
+        # business object -> service name (lower-case identifier)
+        self.services = services or {}
+
+    def __repr__(self):
+        return f"{__class__.__name__}({len(self.names)} business objects)"
+
+    @staticmethod
+    def singular(word: str):
+        if len(word) > 4 and word.endswith("ies"):
+            return word[:-3] + "y"
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            return word[:-1]
+        return word
+
+    @classmethod
+    def _words(cls, text):
+        words = []
+        for token in re.findall(r"[A-Za-z0-9]+", text or ""):
+            words.extend(cls.singular(part.lower()) for part in cls._camel_case_pattern.findall(token))
+        return words
+
+    @classmethod
+    def shared(cls):
+        if cls._shared is None:
+            with cls._lock:
+                if cls._shared is None:
+                    cls._shared = cls.from_documentation()
+        return cls._shared
+
+    @classmethod
+    def from_documentation(cls):
+        from test_cases.name_to_url import NAME_TO_URL
+
+        names = {}
+        services = {}
+        for business_object, url in NAME_TO_URL.items():
+            names[business_object] = frozenset(cls._words(" ".join(business_object.split("_"))))
+            # service name in the URL, e.g. .../default/sap/bankaccountentry/0001
+            if "/default/sap/" in url:
+                service = url.split("/default/sap/", 1)[1].split("/")[0]
+                if service:
+                    services[business_object] = service.lower()
+        return cls(names, services)
+
+    def route(self, query_text: str):
+        """Business objects the query mentions, empty if it mentions none."""
+        words = set(self._words(query_text))
+        identifiers = {token.lower() for token in re.findall(r"[A-Za-z0-9]+", query_text or "")}
+
+        matched = {
+            business_object for business_object, name in self.names.items()
+            if name <= words or self.services.get(business_object) in identifiers
+        }
+        # keep the most specific mentions, then add the objects that extend them
+        specific = {business_object for business_object in matched if not any(self.names[business_object] < self.names[other] for other in matched)}
+        routed = set(specific)
+        for business_object in specific:
+            routed.update(other for other, name in self.names.items() if self.names[business_object] <= name)
+        return sorted(routed)
+
+    def where(self, query_text: str):
+        """Chroma filter matching the chunks of the routed business objects, None if none were found."""
+        business_objects = self.route(query_text)
+        if not business_objects:
+            return None
+        if len(business_objects) == 1:
+            return {"business_object": business_objects[0]}
+        return {"business_object": {"$in": business_objects}}
+
+    def routing_report(self, test_case_folder: str = "test_cases"):
+        """
+        Route the prompts of the test cases (<folder>/<API|SQL>/<business object>/*.json) and
+        count how often the routed objects contain the test case's business object ("hit"),
+        miss it ("missed", only ranked lower by retrieve_many) or are empty ("unrouted").
+        Returns the counts, the average number of routed objects and the missed prompts.
+        """
+        report = {"prompts": 0, "hit": 0, "missed": 0, "unrouted": 0, "routed objects": 0.0, "missed prompts": []}
+        n_routed = 0
+        for category in ("API", "SQL"):
+            category_folder = os.path.join(test_case_folder, category)
+            if not os.path.isdir(category_folder):
+                continue
+            for business_object in sorted(os.listdir(category_folder)):
+                folder = os.path.join(category_folder, business_object)
+                if not os.path.isdir(folder):
+                    continue
+                for file_name in sorted(os.listdir(folder)):
+                    if not file_name.endswith(".json"):
+                        continue
+                    with open(os.path.join(folder, file_name), "r", encoding="utf-8") as f:
+                        prompt = json.load(f).get("input") or ""
+                    routed = self.route(prompt)
+                    report["prompts"] += 1
+                    if not routed:
+                        report["unrouted"] += 1
+                    elif business_object in routed:
+                        report["hit"] += 1
+                    else:
+                        report["missed"] += 1
+                        report["missed prompts"].append((business_object, routed, prompt))
+                    n_routed += len(routed)
+        report["routed objects"] = round(n_routed / max(1, report["hit"] + report["missed"]), 2)
+        return report
@@ -1,68 +1,120 @@
 import os
 import yaml
 import json
-from copy import deepcopy
+from token_handler import fits_token_budget, SPLITTER_ENCODING
 
 with open('config.yaml', 'r') as f:
     cfg = yaml.safe_load(f)
 
 class APIDocumentation():
     all = []
-    def __init__(self, business_object_name: str,  file_name: str, swagger_content: dict, chunks=[]):
+    def __init__(self, business_object_name: str,  file_name: str, swagger_content: dict, chunks=[], file_path: str = None, register: bool = True):
         self.business_object_name = business_object_name
         self.file_name = file_name
         self.swagger_content = swagger_content
         self.chunks = chunks
+        self.file_path = file_path
 
-        APIDocumentation.all.append(self)
+        # unregistered instances are not kept alive by APIDocumentation.all
+        if register:
+            APIDocumentation.all.append(self)
 
     def __repr__(self):
         return f"{__class__.__name__}('{self.business_object_name}')"
 
 
     @classmethod
-    def load_api_json_files(cls):
-        api_json_files = []
+    def find_api_json_files(cls, file_paths=None):
+        """List the API specs in the source folder without loading them."""
+        api_files = []
         source_folder = cfg.get('system_documentation', {}).get('source_folder')
         for root, dirs, files in os.walk(source_folder):
             for file in files:
                 if file.startswith("API_") and file.endswith(".json"):
                     file_path = os.path.join(root, file)
+                    # optionally only load a subset of files (e.g. the ones changed since the last ingestion)
+                    if file_paths is not None and os.path.normpath(file_path) not in file_paths:
+                        continue
                     # Get the subfolder name as business object name
                     rel_path = os.path.relpath(root, source_folder)
                     business_object_name = os.path.basename(rel_path) if rel_path != '.' else ''
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            json_content = json.load(f)
-                        api_json_files.append({
-                            'business_object_name': str(business_object_name),
-                            'file_name': str(file),
-                            'swagger_content': dict(json_content)
-                        })
-                    except Exception as e:
-                        # Optionally log or handle error
-                        pass
+                    api_files.append({
+                        'business_object_name': str(business_object_name),
+                        'file_name': str(file),
+                        'file_path': os.path.normpath(file_path),
+                    })
+        return api_files
+
+    @classmethod
+    def load_api_json_files(cls, file_paths=None):
+        api_json_files = []
+        for api_file in cls.find_api_json_files(file_paths):
+            try:
+                with open(api_file['file_path'], 'r', encoding='utf-8') as f:
+                    json_content = json.load(f)
+                api_json_files.append({
+                    **api_file,
+                    'swagger_content': dict(json_content)
+                })
+            except Exception as e:
+                # Optionally log or handle error
+                pass
         return api_json_files
     
     @classmethod
-    def instanciate_from_json_list(cls):
-        json_list = cls.load_api_json_files()
+    def iter_from_json_files(cls, file_paths=None):
+        """
+        Load the API specs one at a time without registering them in APIDocumentation.all,
+        so each spec can be garbage collected as soon as the caller is done with it.
+        """
+        for api_file in cls.find_api_json_files(file_paths):
+            documentation = cls.load_api_json_file(api_file)
+            if documentation is not None:
+                yield documentation
+
+    @classmethod
+    def load_api_json_file(cls, api_file: dict):
+        """Load a single spec (as listed by find_api_json_files) as an unregistered instance."""
+        try:
+            with open(api_file['file_path'], 'r', encoding='utf-8') as f:
+                json_content = json.load(f)
+        except Exception as e:
+            print(f"[ERROR] Could not load {api_file['file_path']}: {e}")
+            return None
+        return APIDocumentation(
+            business_object_name = api_file.get('business_object_name'),
+            file_name = api_file.get('file_name'),
+            swagger_content = dict(json_content),
+            file_path = api_file.get('file_path'),
+            register = False
+        )
+
+    @classmethod
+    def instanciate_from_json_list(cls, file_paths=None):
+        json_list = cls.load_api_json_files(file_paths)
         for api in json_list:
             APIDocumentation(
                 business_object_name = api.get('business_object_name'),  
                 file_name = api.get('file_name'),
-                swagger_content = api.get('swagger_content')
+                swagger_content = api.get('swagger_content'),
+                file_path = api.get('file_path')
             )
 
 
     def create_swagger_chunks(self):
         self.chunks = self.chunk_swagger_documentation()
-    
+
     def chunk_swagger_documentation(self, include_get: bool = False):
+        """Return all per-endpoint chunks as a list, see iter_swagger_chunks."""
+        return list(self.iter_swagger_chunks(include_get))
+    
+    def iter_swagger_chunks(self, include_get: bool = False):
         """
         Produce per-endpoint chunks with NO information loss.
+        Chunks are yielded one at a time, so callers can embed and store them without
+        keeping the chunks of the whole spec in memory.
 
-        For each path+method we return:
+        For each path+method we yield:
         {
             'http_method': 'POST' | ...,
             'path': '/pets/{id}',
@@ -89,6 +141,9 @@ class APIDocumentation():
         - JSON Pointer unescaping (~0 -> ~, ~1 -> /) supported.
         - Cycle-safe: if a cycle is detected, leaves the $ref as-is at that point.
         - Absolutely no fields are dropped: we always keep the *raw* originals.
+        - Each referenced component is resolved once per spec and the resolved subtree is
+          shared by all chunks that use it; raw parts reference the spec itself. Chunks are
+          therefore read-only views, copy them before modifying anything.
         """
 
         HTTP_METHODS = {'get','post','put','patch','delete','options','head','trace'}
@@ -106,7 +161,7 @@ class APIDocumentation():
                     obj = obj.get(part)
                 else:
                     return None
-            return deepcopy(obj) if isinstance(obj, (dict, list)) else obj
+            return obj
 
         # Track referenced component names by type
         def _new_ref_tracker():
@@ -126,6 +181,41 @@ class APIDocumentation():
             except Exception:
                 pass
 
+        # Per-spec memo of resolved refs: ref -> (resolved subtree, refs expanded while resolving it).
+        # A memoized subtree was resolved with a fresh `seen`; it is only reused where none of
+        # the refs it expanded has been seen yet, which yields exactly the in-place result.
+        pointer_targets = {}
+        resolved_refs = {}
+        resolving = set()
+
+        def _resolve_ref(node, ref, root, seen, tracker):
+            if ref not in pointer_targets:
+                pointer_targets[ref] = _resolve_pointer(ref, root)
+            target = pointer_targets[ref]
+            if target is None:
+                # broken ref: keep as-is
+                return node
+
+            memo = resolved_refs.get(ref)
+            if memo is None and ref not in resolving:
+                resolving.add(ref)
+                memo_seen = {ref}
+                resolved, _ = _resolve_refs_recursive(target, root, memo_seen, _new_ref_tracker())
+                resolving.discard(ref)
+                memo = resolved_refs[ref] = (resolved, frozenset(memo_seen))
+
+            if memo is not None and not (memo[1] & seen):
+                seen |= memo[1]
+                for expanded_ref in memo[1]:
+                    _record_ref(expanded_ref, tracker)
+                return memo[0]
+
+            # ref is being memoized further up (cycle) or overlaps with this traversal: resolve in place
+            seen.add(ref)
+            _record_ref(ref, tracker)
+            resolved, _ = _resolve_refs_recursive(target, root, seen, tracker)
+            return resolved
+
         def _resolve_refs_recursive(node, root, seen=None, tracker=None):
             """
             Deeply resolve {"$ref": "#/..."} dicts by replacement with target object.
@@ -145,14 +235,8 @@ class APIDocumentation():
                     ref = node["$ref"]
                     if ref in seen:
                         # cycle: leave as-is
-                        return deepcopy(node), tracker
-                    target = _resolve_pointer(ref, root)
-                    if target is None:
-                        # broken ref: keep as-is
-                        return deepcopy(node), tracker
-                    seen.add(ref)
-                    _record_ref(ref, tracker)
-                    return _resolve_refs_recursive(target, root, seen, tracker)
+                        return node, tracker
+                    return _resolve_ref(node, ref, root, seen, tracker), tracker
 
                 # Otherwise, resolve values; also handle nested $ref inside dicts
                 out = {}
@@ -169,7 +253,7 @@ class APIDocumentation():
                 return out_list, tracker
 
             # primitives
-            return deepcopy(node), tracker
+            return node, tracker
 
         def _resolve_list(lst):
             if not isinstance(lst, list):
@@ -187,41 +271,41 @@ class APIDocumentation():
             """
             Merge per OAS rules: operation-level overrides path-level by (in, name).
             No loss: the originals are already kept separately.
+            The merged list shares the (read-only) resolved parameter dicts.
             """
             def key(p):
                 return (p.get("in"), p.get("name"))
             merged = []
             seen_keys = set()
             # Start with path-level, but they can be overridden later
-            index = {key(p): deepcopy(p) for p in path_params_resolved if isinstance(p, dict)}
+            index = {key(p): p for p in path_params_resolved if isinstance(p, dict)}
             # Apply/override with op-level
             for p in op_params_resolved:
                 if isinstance(p, dict):
-                    index[key(p)] = deepcopy(p)
+                    index[key(p)] = p
             # Preserve deterministic order: op-level first (more specific), then remaining path-level in original order
             for p in op_params_resolved:
                 k = key(p)
                 if k not in seen_keys:
-                    merged.append(deepcopy(index[k]))
+                    merged.append(index[k])
                     seen_keys.add(k)
             for p in path_params_resolved:
                 k = key(p)
                 if k not in seen_keys:
-                    merged.append(deepcopy(index[k]))
+                    merged.append(index[k])
                     seen_keys.add(k)
             return merged
 
-        chunks = []
         paths = self.swagger_content.get('paths', {}) or {}
         if not isinstance(paths, dict):
-            return chunks
+            return
 
         for path, path_item in paths.items():
             if not isinstance(path_item, dict):
                 continue
 
             # Keep the *raw* path item (no loss)
-            path_item_raw = deepcopy(path_item)
+            path_item_raw = path_item
 
             # Resolve path-level parameters (but keep the raw list too)
             path_level_params_raw = path_item.get('parameters', []) if isinstance(path_item.get('parameters'), list) else []
@@ -237,7 +321,7 @@ class APIDocumentation():
                     continue
 
                 # Raw operation (no changes)
-                operation_raw = deepcopy(operation)
+                operation_raw = operation
 
                 # Resolve operation *entirely* (no summarization)
                 operation_resolved, op_refs = _resolve_refs_recursive(operation_raw, self.swagger_content)
@@ -272,15 +356,63 @@ class APIDocumentation():
                     'referenced_components': {k: sorted(v) for k, v in ref_tracker.items()},
                 }
 
-                chunks.append(chunk)
+                yield chunk
+
+    @classmethod
+    def render_chunk(cls, chunk: dict, fields=None, droppable_fields=None, max_tokens=None):
+        """
+        Compact, canonical text of an endpoint chunk, used as embedding input and (through the
+        stored documents) as prompt context.
+
+        Every piece of information appears once: method and path, the resolved operation
+        without its own parameter list, and the effective (merged, resolved) parameters.
+        The result is minified JSON with the selected fields in the configured order
+        (embedding.api_chunk_fields, None = all fields). If the text exceeds max_tokens
+        (default embedding.max_chunk_size), the droppable fields are removed one by one
+        (embedding.api_chunk_droppable_fields) before the text splitter has to cut it.
+        """
+        embedding_cfg = cfg.get('embedding', {})
+        if fields is None:
+            fields = embedding_cfg.get('api_chunk_fields')
+        if droppable_fields is None:
+            droppable_fields = embedding_cfg.get('api_chunk_droppable_fields') or []
+        if max_tokens is None:
+            max_tokens = embedding_cfg.get('max_chunk_size')
+
+        operation = {k: v for k, v in chunk['operation_resolved'].items() if k != 'parameters'}
+        available = {
+            'method': chunk['http_method'],
+            'path': chunk['path'],
+            **operation,
+            'parameters': chunk['parameters']['effective_parameters_resolved'],
+            'referenced_components': {k: v for k, v in chunk['referenced_components'].items() if v},
+        }
+        if fields is None:
+            fields = [k for k in available if k != 'referenced_components']
+
+        # skip fields the operation does not have
+        selected = {field: available[field] for field in fields if available.get(field) not in (None, [], {})}
 
-        return chunks
+        text = json.dumps(selected, separators=(',', ':'), ensure_ascii=False)
+        for field in droppable_fields:
+            if max_tokens is None or fits_token_budget(text, max_tokens, SPLITTER_ENCODING):
+                break
+            if field in selected:
+                del selected[field]
+                text = json.dumps(selected, separators=(',', ':'), ensure_ascii=False)
+        return text
+
+    def get_rendered_chunks(self):
+        return [self.render_chunk(chunk) for chunk in self.get_chunks()]
 
     def get_business_object_name(self):
         return self.business_object_name
     
     def get_file_name(self):
         return self.file_name
+
+    def get_file_path(self):
+        return self.file_path
     
     def get_swagger_content(self):
         return self.swagger_content
@@ -293,10 +425,11 @@ class APIDocumentation():
 
 class DBDocumentation():
     all = []
-    def __init__(self, business_object_name: str,  file_name: str, db_description: dict):
+    def __init__(self, business_object_name: str,  file_name: str, db_description: dict, file_path: str = None):
         self.business_object_name = business_object_name
         self.file_name = file_name
         self.db_description = db_description
+        self.file_path = file_path
 
         DBDocumentation.all.append(self)
     
@@ -304,13 +437,15 @@ class DBDocumentation():
         return f"{__class__.__name__}('{self.business_object_name}')"
 
     @classmethod
-    def get_db_description_files(cls):
+    def get_db_description_files(cls, file_paths=None):
         db_descriptions = []
         source_folder = cfg.get('system_documentation', {}).get('source_folder')
         for root, dirs, files in os.walk(source_folder):
             for file in files:
                 if file.endswith(".json") and file.startswith('DB_'):
                     file_path = os.path.join(root, file)
+                    if file_paths is not None and os.path.normpath(file_path) not in file_paths:
+                        continue
                     # Get the subfolder name as business_object_name
                     rel_path = os.path.relpath(root, source_folder)
                     business_object_name = os.path.basename(rel_path) if rel_path != '.' else ''
@@ -320,6 +455,7 @@ class DBDocumentation():
                         db_descriptions.append({
                             'business_object_name': business_object_name,
                             'file_name': file,
+                            'file_path': os.path.normpath(file_path),
                             'db_description': db_description
                         })
                     except Exception as e:
@@ -335,23 +471,28 @@ class DBDocumentation():
     
     def get_file_name(self):
         return self.file_name
+
+    def get_file_path(self):
+        return self.file_path
     
     @classmethod
-    def instanciate_from_list(cls):
-        db_descriptions = cls.get_db_description_files()
+    def instanciate_from_list(cls, file_paths=None):
+        db_descriptions = cls.get_db_description_files(file_paths)
         for db_description in db_descriptions:
             DBDocumentation(
                 business_object_name = db_description.get('business_object_name'),
-                file_name = db_description.get('file'),
-                db_description = db_description.get('db_description')
+                file_name = db_description.get('file_name'),
+                db_description = db_description.get('db_description'),
+                file_path = db_description.get('file_path')
             )
 
 class BusinessObjectDescription():
     all = []
-    def __init__(self, business_object_name: str,  file_name: str, business_object_description: str):
+    def __init__(self, business_object_name: str,  file_name: str, business_object_description: str, file_path: str = None):
         self.business_object_name = business_object_name
         self.file_name = file_name
         self.business_object_description = business_object_description
+        self.file_path = file_path
 
         BusinessObjectDescription.all.append(self)
 
@@ -359,13 +500,15 @@ class BusinessObjectDescription():
         return f"{__class__.__name__}('{self.business_object_name}')"
 
     @classmethod
-    def get_business_object_description_files(cls):
+    def get_business_object_description_files(cls, file_paths=None):
         business_object_descriptions = []
         source_folder = cfg.get('system_documentation', {}).get('source_folder')
         for root, dirs, files in os.walk(source_folder):
             for file in files:
                 if file.endswith(".txt"):
                     file_path = os.path.join(root, file)
+                    if file_paths is not None and os.path.normpath(file_path) not in file_paths:
+                        continue
                     # Get the subfolder name as business_object_name
                     rel_path = os.path.relpath(root, source_folder)
                     business_object_name = os.path.basename(rel_path) if rel_path != '.' else ''
@@ -375,6 +518,7 @@ class BusinessObjectDescription():
                         business_object_descriptions.append({
                             'business_object_name': business_object_name,
                             'file_name': file,
+                            'file_path': os.path.normpath(file_path),
                             'business_object_description': business_object_description
                         })
                     except Exception as e:
@@ -383,13 +527,14 @@ class BusinessObjectDescription():
         return business_object_descriptions
     
     @classmethod
-    def instanciate_from_list(cls):
-        bo_descriptions = cls.get_business_object_description_files()
+    def instanciate_from_list(cls, file_paths=None):
+        bo_descriptions = cls.get_business_object_description_files(file_paths)
         for bo_description in bo_descriptions:
             BusinessObjectDescription(
                 business_object_name = bo_description.get('business_object_name'),  
                 file_name = bo_description.get('file_name'),
-                business_object_description = bo_description.get('business_object_description')
+                business_object_description = bo_description.get('business_object_description'),
+                file_path = bo_description.get('file_path')
             )
 
     def get_business_object_name(self):
@@ -397,6 +542,9 @@ class BusinessObjectDescription():
     
     def get_file_name(self):
         return self.file_name
+
+    def get_file_path(self):
+        return self.file_path
     
     def get_business_object_description(self):
         return self.business_object_description
\ No newline at end of file
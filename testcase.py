@@ -5,9 +5,12 @@ import re
 import time
 import ast
 import pandas as pd
+from call_tracker import CallTracker
 
 class Testcase:
     all = []
+    # purposes of the LLM calls that are totalled separately in the usage summary and overview
+    call_purposes = ("sub_query", "sub_answer", "relevance", "final")
     def __init__(
             self, 
             test_case_type, 
@@ -29,7 +32,8 @@ class Testcase:
             component_matching_result=[], 
             exact_match_result=None, 
             execution_result=None,
-            execution_error_message = ""
+            execution_error_message = "",
+            llm_calls=None
         ):
         # Run validations to the received arguments
         assert test_case_type in ('SQL', 'API'), f"test_case_type must either be 'SQL' or 'API'. Received {test_case_type} instead."
@@ -63,6 +67,7 @@ class Testcase:
         self.exact_match_result = exact_match_result
         self.execution_result = execution_result
         self.execution_error_message = execution_error_message
+        self.llm_calls = llm_calls
 
         # Actions to be executed
         Testcase.all.append(self)
@@ -229,7 +234,9 @@ class Testcase:
                             "limit match": limit_match,
                             "exact_match_result": raw_data.get('exact_match_result'),
                             "execution_result": raw_data.get('execution_result'),
-                            "execution_error_message": raw_data.get('execution_error_message')
+                            "execution_error_message": raw_data.get('execution_error_message'),
+                            # token usage and latency per framework stage
+                            **CallTracker.summarize(raw_data.get('llm_calls'), purposes=cls.call_purposes)
                         }
 
                         data.append(my_dict)
@@ -299,6 +306,14 @@ class Testcase:
     def get_corag_number_of_iterations(self):
         return self.corag_number_of_iterations
 
+    def add_llm_calls(self, llm_calls: list):
+        if self.llm_calls is None:
+            self.llm_calls = []
+        self.llm_calls.extend(llm_calls)
+
+    def get_llm_calls(self):
+        return self.llm_calls
+
     def get_type(self):
             return self.test_case_type
     
@@ -371,7 +386,10 @@ class Testcase:
             "component_matching_result": self.component_matching_result,
             "exact_match_result": self.exact_match_result,
             "execution_result": self.execution_result,
-            "execution_error_message": self.execution_error_message
+            "execution_error_message": self.execution_error_message,
+            # every LLM and embedding call of the test case, see CallTracker
+            "llm_calls": self.llm_calls,
+            "usage_summary": CallTracker.summarize(self.llm_calls, purposes=self.call_purposes)
         }
 
         # Write JSON
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import yaml
+
+with open('config.yaml', 'r') as f:
+    cfg = yaml.safe_load(f)
+
+# Encoding used by the TokenTextSplitter that built the index (langchain's default).
+# Changing it would move all chunk boundaries and therefore all chunk ids.
+SPLITTER_ENCODING = "gpt2"
+
+# Shared, lazily created tokenizer objects. Loading a tiktoken encoding or building a
+# TokenTextSplitter is far more expensive than tokenizing a typical DB or TXT description.
+_lock = threading.Lock()
+_encodings = {}
+_text_splitter = None
+_embedding_encoding_name = None
+_model_encoding_names = {}
+
+# Token counts per (encoding, text hash), so that repeated budget checks do not re-tokenize
+_token_counts = OrderedDict()
+_max_cached_token_counts = 65536
+
+
+def get_encoding(encoding_name: str):
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        import tiktoken
+        with _lock:
+            encoding = _encodings.get(encoding_name)
+            if encoding is None:
+                encoding = _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return encoding
+
+
+def embedding_encoding_name():
+    """Name of the tiktoken encoding of the configured embedding model."""
+    global _embedding_encoding_name
+    if _embedding_encoding_name is None:
+        import tiktoken
+        try:
+            _embedding_encoding_name = tiktoken.encoding_name_for_model(cfg.get('embedding', {}).get('openAI_embedding_model'))
+        except KeyError:
+            _embedding_encoding_name = "cl100k_base"
+    return _embedding_encoding_name
+
+
+def encoding_name_for_model(model: str, default: str = "o200k_base"):
+    """Name of the tiktoken encoding of a model, `default` for models tiktoken does not know (e.g. grok)."""
+    encoding_name = _model_encoding_names.get(model)
+    if encoding_name is None:
+        import tiktoken
+        try:
+            encoding_name = tiktoken.encoding_name_for_model(model)
+        except KeyError:
+            encoding_name = default
+        _model_encoding_names[model] = encoding_name
+    return encoding_name
+
+
+def count_tokens(text: str, encoding_name: str = None):
+    """Number of tokens of `text`; defaults to the encoding of the embedding model."""
+    if encoding_name is None:
+        encoding_name = embedding_encoding_name()
+    key = (encoding_name, hashlib.sha1(text.encode("utf-8")).digest())
+    with _lock:
+        n_tokens = _token_counts.get(key)
+        if n_tokens is not None:
+            _token_counts.move_to_end(key)
+            return n_tokens
+
+    n_tokens = len(get_encoding(encoding_name).encode(text, disallowed_special=()))
+
+    with _lock:
+        _token_counts[key] = n_tokens
+        if len(_token_counts) > _max_cached_token_counts:
+            _token_counts.popitem(last=False)
+    return n_tokens
+
+
+def batch_texts(texts, max_batch_size: int = None, max_batch_tokens: int = None):
+    """
+    Split texts into consecutive batches for embedding requests, each with at most
+    max_batch_size texts and max_batch_tokens tokens (defaults: the embedding section of
+    config.yaml). A single text above the token limit becomes a batch of its own.
+    """
+    if max_batch_size is None:
+        max_batch_size = cfg.get('embedding', {}).get('max_batch_size', 2048)
+    if max_batch_tokens is None:
+        max_batch_tokens = cfg.get('embedding', {}).get('max_batch_tokens', 300000)
+
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        n_tokens = count_tokens(text)
+        if batch and (len(batch) >= max_batch_size or batch_tokens + n_tokens > max_batch_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += n_tokens
+    if batch:
+        yield batch
+
+
+def fits_token_budget(text: str, max_tokens: int, encoding_name: str = None):
+    # every token covers at least one byte, so texts with at most max_tokens bytes always fit
+    if len(text) <= max_tokens and len(text.encode("utf-8")) <= max_tokens:
+        return True
+    return count_tokens(text, encoding_name) <= max_tokens
+
+
+def get_text_splitter():
+    global _text_splitter
+    if _text_splitter is None:
+        from langchain_text_splitters import TokenTextSplitter
+        with _lock:
+            if _text_splitter is None:
+                _text_splitter = TokenTextSplitter(
+                    encoding_name=SPLITTER_ENCODING,
+                    chunk_size=cfg.get('embedding', {}).get('max_chunk_size'),
+                    chunk_overlap=cfg.get('embedding', {}).get('chunk_overlap'),
+                )
+    return _text_splitter
+
+
+def split_text(text: str):
+    """
+    Split a text into chunks of at most max_chunk_size tokens (with chunk_overlap).
+    Texts that fit into a single chunk are returned as they are, which is what the
+    splitter would produce, without building the splitter or tokenizing them twice.
+    """
+    if not text:
+        return []
+    if fits_token_budget(text, cfg.get('embedding', {}).get('max_chunk_size'), SPLITTER_ENCODING):
+        return [text]
+    return get_text_splitter().split_text(text)
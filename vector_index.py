@@ -0,0 +1,220 @@
+import os
+import json
+import threading
+import numpy as np
+from embedding_storage import EmbeddingStorage
+from columnar_store import ColumnarStore
+from retrieval_router import MetadataFilter
+
+
+class NumpyVectorIndex():
+    """
+    In-process exact vector index of one collection, built from the sidecars that the
+    ingestion writes next to Chroma: either the JSON files (<persist_dir>/<collection>/<id>.json)
+    or the columnar store (see ColumnarStore), depending on `sidecar_format`.
+
+    All embeddings are held in one contiguous matrix and a query is answered with a matrix
+    product and argpartition, so retrieval needs neither a Chroma client nor its HNSW index
+    and also works in worker processes. A columnar store is used memory-mapped in its stored
+    precision, so it opens in milliseconds and processes share its pages; float16 and int8
+    matrices are expanded to float32 only block by block while searching, so they also keep
+    their smaller memory footprint. JSON sidecars are decoded into a float32 matrix.
+    query() returns the same structure as chromadb's Collection.query. Distances are
+    squared L2 (Chroma's default) or cosine distance, set by `numpy_index_metric` in config.yaml.
+    """
+    metrics = ("l2", "cosine")
+    # rows of a float16 / int8 matrix that are expanded to float32 at once
+    block_size = 8192
+
+    # loaded indexes per (persist dir, collection, metric, sidecar format), shared by all threads of the process
+    _indexes = {}
+    _lock = threading.Lock()
+
+    def __init__(self, persist_dir: str, collection_name: str, metric: str = "l2", sidecar_format: str = "json"):
+        if metric not in self.metrics:
+            raise ValueError(f"Unknown metric: {metric}")
+        self.persist_dir = persist_dir
+        self.collection_name = collection_name
+        self.metric = metric
+        self.sidecar_format = sidecar_format
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        # matrix rows of the indexed chunks, None if every row belongs to a chunk
+        self.rows = None
+        # per-chunk scales of an int8 matrix
+        self.scales = None
+        self.squared_norms = np.zeros(0, dtype=np.float32)
+        self._texts = None
+        self._text_spans = None
+        # chunk positions, embeddings and squared norms per metadata filter
+        self._partitions = {}
+
+    def __repr__(self):
+        return f"{__class__.__name__}('{self.collection_name}', {len(self.ids)} vectors, metric={self.metric})"
+
+    @classmethod
+    def shared(cls, persist_dir: str, collection_name: str, metric: str = "l2", sidecar_format: str = "json"):
+        """Loaded index of a collection, read from disk on first use."""
+        key = (persist_dir, collection_name, metric, sidecar_format)
+        index = cls._indexes.get(key)
+        if index is None:
+            with cls._lock:
+                index = cls._indexes.get(key)
+                if index is None:
+                    index = cls._indexes[key] = cls(persist_dir, collection_name, metric, sidecar_format).load()
+        return index
+
+    @classmethod
+    def invalidate(cls, persist_dir: str, collection_name: str):
+        """Drop loaded indexes of a collection after its sidecars changed."""
+        with cls._lock:
+            for key in [key for key in cls._indexes if key[:2] == (persist_dir, collection_name)]:
+                del cls._indexes[key]
+
+    @staticmethod
+    def collection_names(persist_dir: str):
+        if not os.path.isdir(persist_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(persist_dir)
+            if name.endswith("_embeddings") and os.path.isdir(os.path.join(persist_dir, name))
+        )
+
+    def load(self):
+        folder = os.path.join(self.persist_dir, self.collection_name)
+        if not os.path.isdir(folder):
+            raise ValueError(f"Collection {self.collection_name} does not exist.")
+        if self.sidecar_format == "columnar":
+            self._load_columnar(folder)
+        else:
+            self._load_json(folder)
+        if len(self.ids):
+            self.squared_norms = np.concatenate([np.einsum("ij,ij->i", block, block) for block in self._blocks(self.matrix, self.rows, self.scales)])
+        return self
+
+    def _load_columnar(self, folder):
+        if not ColumnarStore.exists(folder):
+            # sidecars written before the switch to the columnar format are only migrated by the
+            # next ingestion (or ColumnarStore.migrate), until then they are read as they are
+            if any(file_name.endswith(".json") for file_name in os.listdir(folder)):
+                print(f"[WARN] {self.collection_name} has no columnar store yet, loading its JSON sidecars (see ColumnarStore.migrate)")
+                self._load_json(folder)
+            return
+        store = ColumnarStore(folder)
+        columns = store.load()
+        store.close()
+        self.ids = columns["ids"]
+        self.metadatas = columns["metadata"]
+        self._texts = columns["texts"]
+        self._text_spans = list(zip(columns["text_offsets"], columns["text_lengths"]))
+        if not self.ids:
+            return
+        matrix, rows = columns["matrix"], columns["rows"]
+        # keep the memory map in its stored precision, deleted or not yet committed rows are skipped via self.rows
+        self.matrix = matrix
+        if not (len(rows) == matrix.shape[0] and rows[-1] == len(rows) - 1):
+            self.rows = rows
+        self.scales = columns["scales"]
+
+    def _load_json(self, folder):
+        embeddings = []
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(folder, file_name), "r", encoding="utf-8") as f:
+                record = json.load(f)
+            self.ids.append(record["id"])
+            self.documents.append(record.get("text"))
+            self.metadatas.append(record.get("metadata"))
+            embeddings.append(EmbeddingStorage.decode(record["embedding"]))
+
+        if embeddings:
+            self.matrix = np.vstack(embeddings).astype(np.float32, copy=False)
+
+    def count(self):
+        return len(self.ids)
+
+    def _document(self, i):
+        if self._text_spans is None:
+            return self.documents[i]
+        offset, length = self._text_spans[i]
+        return bytes(self._texts[offset:offset + length]).decode("utf-8")
+
+    def _metadata(self, i):
+        metadata = self.metadatas[i]
+        return json.loads(metadata) if isinstance(metadata, str) else metadata
+
+    def _partition(self, where):
+        """
+        Chunks matching a metadata filter as (positions, matrix, squared norms, scales). The
+        rows are copied once per filter in their stored precision, so filtered queries only
+        compute distances to the partition.
+        """
+        key = MetadataFilter.key(where)
+        partition = self._partitions.get(key)
+        if partition is None:
+            positions = np.array([i for i in range(len(self.ids)) if MetadataFilter.matches(self._metadata(i), where)], dtype=np.int64)
+            rows = positions if self.rows is None else self.rows[positions]
+            scales = None if self.scales is None else self.scales[positions]
+            partition = self._partitions[key] = (positions, np.asarray(self.matrix[rows]), self.squared_norms[positions], scales)
+        return partition
+
+    def _blocks(self, matrix, rows, scales):
+        """float32 embeddings of the chunks (matrix rows `rows`, all if None) in blocks of block_size."""
+        n_chunks = matrix.shape[0] if rows is None else len(rows)
+        for start in range(0, n_chunks, self.block_size):
+            stop = min(n_chunks, start + self.block_size)
+            values = matrix[start:stop] if rows is None else matrix[rows[start:stop]]
+            yield EmbeddingStorage.dequantize(values, None if scales is None else scales[start:stop, None])
+
+    def _distances(self, queries, matrix, rows, squared_norms, scales=None):
+        if matrix.dtype == np.float32:
+            similarities = queries @ matrix.T
+            if rows is not None:
+                similarities = similarities[:, rows]
+        else:
+            similarities = np.hstack([queries @ block.T for block in self._blocks(matrix, rows, scales)])
+        query_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        if self.metric == "cosine":
+            norms = np.sqrt(query_norms * squared_norms[None, :])
+            norms[norms == 0] = 1.0
+            return 1.0 - similarities / norms
+        return np.maximum(query_norms + squared_norms[None, :] - 2.0 * similarities, 0.0)
+
+    def query(self, query_embeddings, n_results: int = 10, where=None):
+        """
+        Exact top-n search, optionally restricted by a metadata filter (Chroma `where` syntax);
+        returns ids, documents, metadatas and distances per query like chromadb.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        positions = None
+        matrix, rows, squared_norms, scales = self.matrix, self.rows, self.squared_norms, self.scales
+        if where and len(self.ids):
+            positions, matrix, squared_norms, scales = self._partition(where)
+            rows = None
+        n_candidates = len(self.ids) if positions is None else len(positions)
+        n_results = min(n_results, n_candidates)
+
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if n_results == 0:
+            for key in result:
+                result[key] = [[] for _ in range(len(queries))]
+            return result
+
+        distances = self._distances(queries, matrix, rows, squared_norms, scales)
+        if n_results < n_candidates:
+            candidates = np.argpartition(distances, n_results - 1, axis=1)[:, :n_results]
+        else:
+            candidates = np.broadcast_to(np.arange(n_candidates), distances.shape)
+        for row, row_candidates in zip(distances, candidates):
+            top = row_candidates[np.argsort(row[row_candidates], kind="stable")]
+            chunks = top if positions is None else positions[top]
+            result["ids"].append([self.ids[i] for i in chunks])
+            result["documents"].append([self._document(i) for i in chunks])
+            result["metadatas"].append([self._metadata(i) for i in chunks])
+            result["distances"].append([float(row[i]) for i in top])
+        return result